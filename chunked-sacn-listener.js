@@ -0,0 +1,21 @@
+// Chunked companion to rgb-sacn-listener.js.  The pixel buffer is split into
+// exported arrays of CHUNK pixels each, so sacnproxy.py can send only the
+// chunks that have changed since the last frame.  The proxy detects this
+// pattern by its pixels0 array, and reads the chunk size from its length.
+// Up to 8 chunks of 128 pixels (1024 pixels) are supported.
+var CHUNK = 128
+export var pixels0 = array(CHUNK)
+export var pixels1 = array(CHUNK)
+export var pixels2 = array(CHUNK)
+export var pixels3 = array(CHUNK)
+export var pixels4 = array(CHUNK)
+export var pixels5 = array(CHUNK)
+export var pixels6 = array(CHUNK)
+export var pixels7 = array(CHUNK)
+var chunks = [pixels0, pixels1, pixels2, pixels3, pixels4, pixels5, pixels6, pixels7]
+
+export function render(index) {
+  var p = chunks[floor(index / CHUNK)][index % CHUNK]
+  r = (p >> 8) & 0xff; g = p & 0xff; b = (p * 256 + .5) & 0xff
+  rgb(r, g, b)
+}
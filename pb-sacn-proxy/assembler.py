@@ -0,0 +1,180 @@
+"""
+ assembler.py
+
+ Frame coherent assembly of multi-universe sACN data.  Universe packets are
+ collected into a pending frame, which is published exactly once, when:
+
+   - every active universe has reported since the last frame, or
+   - an E1.31 synchronization packet arrives for a frame whose packets
+     carried that sync address, or
+   - a universe reports a second time, meaning the source has started its
+     next frame and the missing universes aren't coming, or
+   - the frame deadline expires.
+
+ Packets that fail the E1.31 sequence number check are discarded.  Counters
+ track incomplete frames, late universes (which arrived after their frame
+ was published on deadline) and out of order packets.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import threading
+import time
+
+# E1.31 network data loss timeout.  A universe we haven't heard from in this
+# long no longer counts toward frame completion.
+UNIVERSE_TIMEOUT = 2.5
+
+
+class FrameAssembler:
+    """
+    Tracks which universes have contributed to the pending frame and decides
+    when it is ready to send.  The publish function passed to the constructor
+    is called, with the assembler's lock held, each time a frame is ready.
+    """
+    deadline = 0.04        # seconds to wait for the rest of a frame
+    universes = None       # all universes we're listening to
+    frames = 0
+    incomplete = 0
+    late = 0
+    outOfOrder = 0
+
+    def __init__(self, universes, publish, deadline = None):
+        self.lock = threading.Lock()
+        self.pendingEvent = threading.Event()   # set while a frame is pending
+        self.universes = frozenset(universes)
+        self.publish = publish
+        if (deadline is not None):
+            self.deadline = deadline
+
+        self.packets = dict()      # universe -> packets accepted
+        self._pending = set()      # universes received for the pending frame
+        self._missing = set()      # universes absent from the last published frame
+        self._lastSeen = dict()    # universe -> time.monotonic() of last packet
+        self._sequence = dict()    # universe -> last accepted sequence number
+        self._active = 0           # number of universes expected per frame
+        self._syncAddr = 0         # sync universe the pending frame is waiting on
+        self._discovering = False  # True while new universes are joining the pending frame
+        self._frameStart = 0
+
+    def receive(self, universe, sequence, syncAddr, pack, data):
+        """
+        Called from the receiver thread for each universe packet.  Validates the
+        sequence number, unless it's None because the caller already has,
+        calls pack(data, universe) to store the packet's pixels and publishes
+        the frame if it's now complete.
+        Returns False if the packet was discarded.
+        """
+        if (universe not in self.universes):
+            return False
+        now = time.monotonic()
+        with self.lock:
+            last = None if (sequence is None) else self._sequence.get(universe)
+            if (last is not None):
+                # E1.31 6.7.2: discard if -20 < (new - last) <= 0, modulo 256
+                diff = (sequence - last) & 0xff
+                if (diff == 0 or diff > 236):
+                    self.outOfOrder += 1
+                    return False
+            if (sequence is not None):
+                self._sequence[universe] = sequence
+            self.packets[universe] = self.packets.get(universe, 0) + 1
+
+            # a repeat means the source has moved on to its next frame. Ship
+            # what we've got before the new data overwrites it.
+            if (universe in self._pending):
+                self._publish(now)
+
+            if (universe in self._missing):
+                self.late += 1
+                self._missing.discard(universe)
+
+            if (universe not in self._lastSeen or now - self._lastSeen[universe] > UNIVERSE_TIMEOUT):
+                # until the source comes round to a universe it's already sent, we
+                # can't tell whether this frame is complete
+                self._active += 1
+                self._discovering = True
+            self._lastSeen[universe] = now
+
+            pack(data, universe)
+
+            if (not self._pending):
+                self._frameStart = now
+                self.pendingEvent.set()
+            self._pending.add(universe)
+            if (syncAddr):
+                self._syncAddr = syncAddr
+            elif (len(self._pending) >= self._active and not (self._syncAddr or self._discovering)):
+                self._publish(now)
+
+        return True
+
+    def update(self, universe, pack, data):
+        """
+        Calls pack(data, universe) to update a universe's pixels without
+        counting it toward the pending frame -- for merged data triggered by
+        a source other than the one that sets the universe's frame timing.
+        """
+        if (universe not in self.universes):
+            return False
+        with self.lock:
+            self.packets[universe] = self.packets.get(universe, 0) + 1
+            pack(data, universe)
+        return True
+
+    def sync(self, syncAddr):
+        """Called when an E1.31 synchronization packet arrives"""
+        with self.lock:
+            if (self._pending and self._syncAddr == syncAddr):
+                self._publish(time.monotonic())
+
+    def expire(self):
+        """
+        Publishes the pending frame if its deadline has passed.  Returns True
+        if a frame was published.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if (self._pending and now - self._frameStart >= self.deadline):
+                self._publish(now)
+                return True
+        return False
+
+    def timeout(self):
+        """
+        Returns the number of seconds until the pending frame's deadline, or None
+        if no frame is pending.
+        """
+        if (not self._pending):
+            return None
+        return max(0, self._frameStart + self.deadline - time.monotonic())
+
+    def _publish(self, now):
+        """Utility method: publish the pending frame and start a new one. Lock must be held."""
+        self.frames += 1
+        expected = set(u for u, t in self._lastSeen.items() if (now - t <= UNIVERSE_TIMEOUT))
+        self._active = len(expected)
+        self._missing = expected - self._pending
+        if (self._missing):
+            self.incomplete += 1
+
+        self._pending.clear()
+        self.pendingEvent.clear()
+        self._syncAddr = 0
+        self._discovering = False
+        self.publish()
@@ -0,0 +1,408 @@
+"""
+ benchmark.py
+
+ Offline end-to-end benchmark for sacnProxy.  Needs no lighting software and
+ no Pixelblaze -- everything runs on loopback:
+
+   E131Generator  - sends frames of E1.31 data at a fixed rate, changing a
+                    configurable fraction of the pixels in each frame
+   FakePixelblaze - a minimal websocket server that answers getConfig,
+                    getVars, listPrograms and ping like a Pixelblaze, and
+                    timestamps every setVars frame it receives
+   run_benchmark  - runs a proxy between the two and reports throughput,
+                    dropped frames and input-to-output latency
+   check_batching - checks the order in which batched Pixelblaze commands
+                    reach the fake Pixelblaze
+
+ The generator and the fake Pixelblazes run in their own processes, so they
+ don't compete with the proxy for the GIL.  Each frame's number is written
+ into the first pixel of every universe, which lets the fake Pixelblaze tell
+ which input frame each setVars message carries.
+
+ Run it directly, for example:
+
+   python benchmark.py --universes 8 --outputs 2 --fps 40 --seconds 10
+
+ With --max-p99 <ms> or --min-fps <fps>, the exit status is nonzero if the
+ run misses the target, so the benchmark can serve as a regression check.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from e131receiver import make_packet, E131_PORT
+import multiprocessing
+import socketserver
+import threading
+import hashlib
+import base64
+import random
+import socket
+import struct
+import json
+import re
+import time
+import os
+
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class E131Generator:
+    """
+    Sends <universes> universes of RGB pixel data to addr:port, fps frames
+    per second.  changeRate is the fraction of pixels given new random values
+    in each frame; the first pixel of every universe always carries the
+    24-bit frame number.
+    """
+    universes = 4
+    firstUniverse = 1
+    pixelsPerUniverse = 170
+    fps = 40
+    changeRate = 1.0
+
+    def __init__(self, universes = 4, fps = 40, changeRate = 1.0, addr = "127.0.0.1", port = E131_PORT,
+                 firstUniverse = 1, pixelsPerUniverse = 170):
+        self.universes = universes
+        self.fps = fps
+        self.changeRate = max(0.0, min(1.0, changeRate))
+        self.addr = addr
+        self.port = port
+        self.firstUniverse = firstUniverse
+        self.pixelsPerUniverse = max(1, min(170, pixelsPerUniverse))
+
+    def run(self, seconds):
+        """
+        Sends frames for the given number of seconds.  Returns a list of the
+        time.monotonic() times at which each frame finished sending, indexed
+        by frame number.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        n = self.pixelsPerUniverse
+        changes = int(round(self.changeRate * (n - 1)))
+        data = [bytearray(os.urandom(3 * n)) for u in range(self.universes)]
+        sent = []
+        start = time.monotonic()
+        frame = 0
+        while (True):
+            due = start + frame / self.fps
+            now = time.monotonic()
+            if (due - start >= seconds):
+                break
+            if (due > now):
+                time.sleep(due - now)
+
+            for u in range(self.universes):
+                buf = data[u]
+                if (changes == n - 1):
+                    buf[3:] = os.urandom(3 * (n - 1))
+                else:
+                    for p in random.sample(range(1, n), changes):
+                        buf[3 * p:3 * p + 3] = os.urandom(3)
+                buf[0:3] = frame.to_bytes(3, "big")
+                sock.sendto(make_packet(self.firstUniverse + u, buf, frame), (self.addr, self.port))
+            sent.append(time.monotonic())
+            frame += 1
+        sock.close()
+        return sent
+
+
+# the first pixel value of a frame, wherever its setVars falls in the message
+_FIRST_PIXEL = re.compile(rb'"setVars"\s*:\s*\{\s*"pixels"\s*:\s*\[\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)')
+
+
+class _WebsocketHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of a websocket server to stand in for a Pixelblaze: a
+    single connection, unfragmented frames, text messages only.
+    """
+
+    def handle(self):
+        request = b""
+        while (b"\r\n\r\n" not in request):
+            chunk = self.request.recv(4096)
+            if (not chunk):
+                return
+            request += chunk
+        key = b""
+        for line in request.split(b"\r\n"):
+            if (line.lower().startswith(b"sec-websocket-key:")):
+                key = line.split(b":", 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+        self.request.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                             b"Connection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        server = self.server
+        while (True):
+            header = self.rfile.read(2)
+            if (len(header) < 2):
+                return
+            opcode = header[0] & 0x0f
+            n = header[1] & 0x7f
+            if (n == 126):
+                n = struct.unpack("!H", self.rfile.read(2))[0]
+            elif (n == 127):
+                n = struct.unpack("!Q", self.rfile.read(8))[0]
+            mask = self.rfile.read(4) if (header[1] & 0x80) else None
+            payload = self.rfile.read(n)
+            t = time.monotonic()
+            if (mask is not None):
+                key = int.from_bytes((mask * (n // 4 + 1))[:n], "big")
+                payload = (int.from_bytes(payload, "big") ^ key).to_bytes(n, "big")
+
+            if (opcode == 0x8):
+                return
+            elif (opcode == 0x9):
+                self.send(payload, 0xa)
+            elif (opcode == 0x1):
+                self.on_message(server, payload, t)
+
+    def send(self, payload, opcode = 0x1):
+        n = len(payload)
+        if (n < 126):
+            header = struct.pack("!BB", 0x80 | opcode, n)
+        elif (n < 65536):
+            header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+        self.request.sendall(header + payload)
+
+    def on_message(self, server, msg, t):
+        # the frame number is in the first pixel -- no need to parse the rest.
+        # Frames may follow batched commands in the same message, and other
+        # setVars messages aren't frames at all.
+        m = _FIRST_PIXEL.search(msg)
+        if (m is not None):
+            frame = round(float(m.group(1)) * 256) & 0xffffff
+            server.frames.append((frame, t, len(msg)))
+        elif (b'"ping"' in msg):
+            self.send(b'{"ack":1}')
+        elif (b'"getConfig"' in msg):
+            self.send(json.dumps({"name": "benchmark", "pixelCount": server.pixelCount}).encode("utf-8"))
+            self.send(b'{"activeProgram":{"name":"benchmark","activeProgramId":"benchmark","controls":{}}}')
+        elif (b'"getVars"' in msg):
+            self.send(json.dumps({"vars": {"pixels": [0] * server.pixelCount}}).encode("utf-8"))
+        elif (b'"listPrograms"' in msg):
+            self.send(b"\x07\x04benchmark\tbenchmark\nother\tother", 0x2)
+        else:
+            server.commands.append(json.loads(msg))
+
+
+class FakePixelblaze(socketserver.ThreadingTCPServer):
+    """
+    Stand-in Pixelblaze listening on addr:port.  Every setVars message is
+    recorded in frames as (frameNumber, time.monotonic(), bytes), and every
+    other command, decoded, in commands.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr = "127.0.0.1", port = 81, pixelCount = 680):
+        self.pixelCount = pixelCount
+        self.frames = []
+        self.commands = []
+        super().__init__((addr, port), _WebsocketHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-pb-%d" % self.server_address[1], daemon=True).start()
+
+
+def _serve(ports, pixelCount, ready, stop, results):
+    """Benchmark helper: runs fake Pixelblazes until stop is set, then returns what they received"""
+    servers = [FakePixelblaze("127.0.0.1", port, pixelCount) for port in ports]
+    for s in servers:
+        s.start()
+    ready.set()
+    stop.wait()
+    for s in servers:
+        s.shutdown()
+    results.put([s.frames for s in servers])
+
+
+def _generate(gen, seconds, results):
+    """Benchmark helper: runs the E1.31 generator and returns its frame times"""
+    results.put(gen.run(seconds))
+
+
+def _percentile(values, p):
+    if (not values):
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def run_benchmark(universes = 4, outputs = 1, fps = 40, seconds = 5, changeRate = 1.0, maxFps = 60,
+                  adaptiveMs = None, nativeReceiver = True, workers = 0, port = 8081):
+    """
+    Runs a proxy between an E1.31 generator and <outputs> fake Pixelblazes,
+    which share the universes equally, and returns a dictionary of results.
+    Latency is measured from the end of each input frame to the arrival of
+    the setVars message carrying it.
+    """
+    from sacnproxy import sacnProxy
+
+    perOutput = max(1, universes // outputs)
+    ports = [port + i for i in range(outputs)]
+    ctx = multiprocessing.get_context("spawn")
+    ready, stop = ctx.Event(), ctx.Event()
+    serverResults, genResults = ctx.Queue(), ctx.Queue()
+    server = ctx.Process(target=_serve, args=(ports, perOutput * 170, ready, stop, serverResults), daemon=True)
+    server.start()
+    ready.wait(10)
+
+    proxy = sacnProxy("127.0.0.1", nativeReceiver=nativeReceiver)
+    proxy.maxUniverses = perOutput
+    for p in ports:
+        proxy.addOutput("127.0.0.1:%d" % p)
+    proxy.setMaxOutputFps(maxFps)
+    if (adaptiveMs is not None):
+        proxy.setAdaptiveRate(adaptiveMs)
+    proxy.setWorkerProcesses(workers)
+    threading.Thread(target=proxy.run, name="proxy", daemon=True).start()
+    time.sleep(1.0 if workers else 0.3)
+
+    cpu = time.process_time()
+    gen = E131Generator(perOutput * outputs, fps, changeRate)
+    generator = ctx.Process(target=_generate, args=(gen, seconds, genResults), daemon=True)
+    generator.start()
+    sent = genResults.get()
+    generator.join()
+    cpu = time.process_time() - cpu
+    time.sleep(0.5)  # let the last frames drain
+
+    stop.set()
+    received = serverResults.get()
+    server.join()
+    proxy.stop()
+
+    latency = []
+    results = {"framesIn": len(sent), "seconds": seconds, "cpu": 100 * cpu / seconds, "outputs": []}
+    for p, frames in zip(ports, received):
+        distinct = set()
+        for frame, t, n in frames:
+            if ((frame < len(sent)) and (frame not in distinct)):
+                distinct.add(frame)
+                latency.append(t - sent[frame])
+        results["outputs"].append({
+            "port": p,
+            "messages": len(frames),
+            "frames": len(distinct),
+            "dropped": len(sent) - len(distinct),
+            "fps": len(distinct) / seconds,
+            "bytesPerSec": sum(n for frame, t, n in frames) / seconds,
+        })
+    results["fps"] = sum(o["fps"] for o in results["outputs"]) / max(1, outputs)
+    results["dropped"] = sum(o["dropped"] for o in results["outputs"])
+    results["p50"] = _percentile(latency, 50)
+    results["p99"] = _percentile(latency, 99)
+    return results
+
+
+def check_batching(port = 8081):
+    """
+    Sends batched commands to a fake Pixelblaze and checks what arrives.
+    Returns a list of problems found, empty if all is well.
+    """
+    from pixelblaze import Pixelblaze
+
+    server = FakePixelblaze("127.0.0.1", port, 8)
+    server.start()
+    pb = Pixelblaze("127.0.0.1:%d" % port)
+    problems = []
+
+    def expect(name, commands):
+        time.sleep(0.2)
+        if (server.commands != commands):
+            problems.append("%s: sent %r, expected %r" % (name, server.commands, commands))
+        server.commands.clear()
+
+    with pb.batch():
+        pb.setBrightness(0.5)
+        pb.setControl("speed", 0.2)
+        pb.setControl("speed", 0.3)
+        pb.setControl("hue", 0.1)
+    expect("collapse", [{"brightness": 0.5, "setControls": {"speed": 0.3, "hue": 0.1}}])
+
+    # controls for a new pattern must not share the pattern change's message
+    with pb.batch():
+        pb.setActivePattern("other")
+        pb.setControls({"speed": 0.5})
+    expect("pattern change", [{"activeProgramId": "other"}, {"setControls": {"speed": 0.5}}])
+
+    # per frame batching with no frames to carry the commands
+    pb.onQueue = pb.flush
+    pb.setBatching(True)
+    pb.setBrightness(0.25)
+    expect("no frames", [{"brightness": 0.25}])
+
+    pb.close()
+    server.shutdown()
+    server.server_close()
+    return problems
+
+
+def print_report(r):
+    def ms(t):
+        return "--" if (t is None) else "%.1f" % (t * 1000)
+
+    print("input: %d frames in %d s, proxy cpu %.0f%%" % (r["framesIn"], r["seconds"], r["cpu"]))
+    for o in r["outputs"]:
+        print("  port %d: %d frames (%.1f fps), dropped %d, %.1f KB/s" %
+              (o["port"], o["frames"], o["fps"], o["dropped"], o["bytesPerSec"] / 1024))
+    print("output: %.1f fps per Pixelblaze, dropped %d, latency p50 %s ms, p99 %s ms" %
+          (r["fps"], r["dropped"], ms(r["p50"]), ms(r["p99"])))
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for sacnProxy")
+    parser.add_argument("--universes", type=int, default=4, help="total universes sent")
+    parser.add_argument("--outputs", type=int, default=1, help="fake Pixelblazes, sharing the universes")
+    parser.add_argument("--fps", type=float, default=40, help="input frame rate")
+    parser.add_argument("--seconds", type=float, default=5, help="length of the run")
+    parser.add_argument("--change", type=float, default=1.0, help="fraction of pixels changing per frame")
+    parser.add_argument("--max-fps", type=float, default=60, help="proxy output frame rate limit")
+    parser.add_argument("--adaptive", type=float, default=None, help="enable rate control with this target latency (ms)")
+    parser.add_argument("--sacn", action="store_true", help="use the sacn module's receiver")
+    parser.add_argument("--workers", type=int, default=0, help="output worker processes")
+    parser.add_argument("--port", type=int, default=8081, help="first fake Pixelblaze port")
+    parser.add_argument("--max-p99", type=float, default=None, help="fail if p99 latency exceeds this (ms)")
+    parser.add_argument("--min-fps", type=float, default=None, help="fail if output fps falls below this")
+    parser.add_argument("--check-batching", action="store_true", help="check command batching, then exit")
+    args = parser.parse_args()
+
+    if (args.check_batching):
+        problems = check_batching(args.port)
+        for p in problems:
+            print("FAIL: " + p)
+        print("command batching %s" % ("failed" if (problems) else "ok"))
+        sys.exit(1 if problems else 0)
+
+    r = run_benchmark(args.universes, args.outputs, args.fps, args.seconds, args.change, args.max_fps,
+                      args.adaptive, not args.sacn, args.workers, args.port)
+    print_report(r)
+
+    failed = False
+    if ((args.max_p99 is not None) and ((r["p99"] is None) or (r["p99"] * 1000 > args.max_p99))):
+        print("FAIL: p99 latency above %.1f ms" % args.max_p99)
+        failed = True
+    if ((args.min_fps is not None) and (r["fps"] < args.min_fps)):
+        print("FAIL: output below %.1f fps" % args.min_fps)
+        failed = True
+    sys.exit(1 if failed else 0)
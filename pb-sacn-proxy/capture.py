@@ -0,0 +1,369 @@
+"""
+ capture.py
+
+ Records incoming E1.31 data to a file, and plays it back into the proxy,
+ so that real shows can be replayed for tuning, load testing and measuring
+ the pipeline's throughput offline.
+
+ A capture file is a short header followed by an append-only series of
+ records, each a fixed size record header (see _RECORD) and a payload:
+
+   RAW     the packet's channel data
+   DELTA   only the channels that changed since the same source's last
+           packet on the same universe, as (offset, count, data) runs
+   SYNC    an E1.31 synchronization packet
+   SOURCE  a new source: its 16 byte CID, and the index that the records
+           that follow use for it.  A capture holds up to 256 sources;
+           packets from any more aren't recorded.
+
+ Timestamps are seconds since recording started.  If a recording is cut
+ short, the partial record at the end of the file is simply ignored.
+
+ CaptureReader memory-maps the file.  CaptureReplayer feeds its records to
+ a sacnProxy's receive callbacks, at the original speed, faster or slower,
+ or as fast as possible.
+
+ Run this file directly to record a capture, print a summary of one, or
+ measure how fast one can be decoded.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import threading
+import struct
+import mmap
+import time
+import os
+
+CAPTURE_MAGIC = b'PBSACNCAP\0'
+CAPTURE_VERSION = 1
+
+RECORD_RAW = 0
+RECORD_DELTA = 1
+RECORD_SYNC = 2
+RECORD_SOURCE = 3
+
+# magic, version, flags
+_HEADER = struct.Struct("<10sBB")
+# timestamp, universe (sync address for SYNC records), sync address, sequence,
+# priority, options, record type, source index, payload length
+_RECORD = struct.Struct("<dHHBBBBBH")
+# delta run: channel offset, channel count
+_RUN = struct.Struct("<HH")
+
+_DELTA_BLOCK = 16          # granularity, in channels, of change detection for delta records
+_MAX_SOURCES = 256
+
+
+class CaptureWriter:
+    """
+    Appends records to a capture file.  Not thread safe: records are written
+    from the receiver thread.  With delta True, packets are stored as the
+    runs of channels that changed since the source's previous packet on the
+    same universe, whenever that's smaller.
+    """
+    delta = True
+
+    # statistics
+    records = 0
+    rawBytes = 0           # channel data received
+    bytesWritten = 0
+    unrecorded = 0         # packets from sources beyond the _MAX_SOURCES a capture can tell apart
+
+    def __init__(self, filename, delta = True):
+        self.filename = filename
+        self.delta = delta
+        self._file = open(filename, "ab")
+        if (self._file.tell() == 0):
+            self._file.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0))
+        else:
+            with open(filename, "rb") as f:
+                magic, version, flags = _HEADER.unpack(f.read(_HEADER.size))
+            if ((magic != CAPTURE_MAGIC) or (version != CAPTURE_VERSION)):
+                self._file.close()
+                raise ValueError("%s is not a version %d capture file" % (filename, CAPTURE_VERSION))
+        self._start = time.monotonic()
+        self._sources = dict()     # cid -> source index
+        self._last = dict()        # (universe, source index) -> bytes of the last packet
+
+    def _record(self, kind, universe, syncAddr, sequence, priority, options, source, payload):
+        """Utility method: writes one record"""
+        self._file.write(_RECORD.pack(time.monotonic() - self._start, universe, syncAddr, sequence & 0xff,
+                                      priority, options, kind, source, len(payload)))
+        self._file.write(payload)
+        self.records += 1
+        self.bytesWritten += _RECORD.size + len(payload)
+
+    def write(self, universe, data, sequence = 0, priority = 100, syncAddr = 0, cid = b'', options = 0):
+        """
+        Records a data packet; the arguments match the E131Receiver onData
+        callback's.  Returns False if the packet wasn't recorded because the
+        capture already has as many sources as its source index can hold.
+        """
+        cid = bytes(cid)
+        source = self._sources.get(cid)
+        if (source is None):
+            if (len(self._sources) >= _MAX_SOURCES):
+                if (not self.unrecorded):
+                    print("Capture %s is full of sources: not recording new ones" % self.filename)
+                self.unrecorded += 1
+                return False
+            source = len(self._sources)
+            self._sources[cid] = source
+            self._record(RECORD_SOURCE, 0, 0, 0, 0, 0, source, cid.ljust(16, b'\0')[:16])
+
+        data = bytes(data)
+        self.rawBytes += len(data)
+        key = (universe, source)
+        last = self._last.get(key)
+        self._last[key] = data
+        kind = RECORD_RAW
+        payload = data
+        if (self.delta and (last is not None) and (len(last) == len(data))):
+            runs = self.diff(last, data)
+            if (len(runs) < len(data)):
+                kind = RECORD_DELTA
+                payload = runs
+        self._record(kind, universe, syncAddr, sequence, priority, options, source, payload)
+        return True
+
+    def write_sync(self, syncAddr):
+        """Records a synchronization packet"""
+        self._record(RECORD_SYNC, syncAddr, syncAddr, 0, 0, 0, 0, b'')
+
+    @staticmethod
+    def diff(old, new):
+        """Returns the delta record payload that turns old into new, which must be the same length"""
+        runs = []
+        n = len(new)
+        i = 0
+        while (i < n):
+            if (old[i:i + _DELTA_BLOCK] == new[i:i + _DELTA_BLOCK]):
+                i += _DELTA_BLOCK
+                continue
+            start = i
+            while ((i < n) and (old[i:i + _DELTA_BLOCK] != new[i:i + _DELTA_BLOCK])):
+                i += _DELTA_BLOCK
+            end = min(i, n)
+            runs.append(_RUN.pack(start, end - start))
+            runs.append(new[start:end])
+        return b''.join(runs)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture file through a memory map.  records() reconstructs each
+    packet's full channel data, undoing delta compression.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if (self.size < _HEADER.size):
+                raise ValueError("%s is not a capture file" % filename)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags = _HEADER.unpack_from(self._map, 0)
+        if ((magic != CAPTURE_MAGIC) or (version != CAPTURE_VERSION)):
+            self.close()
+            raise ValueError("%s is not a version %d capture file" % (filename, CAPTURE_VERSION))
+
+    def records(self):
+        """
+        Yields (timestamp, type, universe, syncAddr, sequence, priority, options,
+        cid, data) for every DATA (RAW or DELTA) and SYNC record, in file order.
+        data is a memoryview that is only valid until the next record is read.
+        """
+        m = self._map
+        unpack = _RECORD.unpack_from
+        pos = _HEADER.size
+        end = self.size
+        cids = dict()             # source index -> cid
+        frames = dict()           # (universe, source index) -> bytearray of the latest data
+        while (pos + _RECORD.size <= end):
+            t, universe, syncAddr, sequence, priority, options, kind, source, n = unpack(m, pos)
+            pos += _RECORD.size
+            if (pos + n > end):
+                break         # partial record at the end of an interrupted capture
+            payload = m[pos:pos + n]
+            pos += n
+
+            if (kind == RECORD_RAW):
+                frame = frames[(universe, source)] = bytearray(payload)
+            elif (kind == RECORD_DELTA):
+                frame = frames[(universe, source)]
+                i = 0
+                while (i < n):
+                    ofs, count = _RUN.unpack_from(payload, i)
+                    i += _RUN.size
+                    frame[ofs:ofs + count] = payload[i:i + count]
+                    i += count
+            elif (kind == RECORD_SYNC):
+                yield (t, kind, universe, syncAddr, 0, 0, 0, None, None)
+                continue
+            elif (kind == RECORD_SOURCE):
+                cids[source] = bytes(payload)
+                continue
+            else:
+                continue
+            yield (t, kind, universe, syncAddr, sequence, priority, options, cids.get(source, b''), memoryview(frame))
+
+    def summary(self):
+        """Returns a dictionary describing the capture"""
+        universes = set()
+        sources = set()
+        packets = syncs = raw = 0
+        duration = 0
+        for t, kind, universe, syncAddr, sequence, priority, options, cid, data in self.records():
+            duration = t
+            if (kind == RECORD_SYNC):
+                syncs += 1
+                continue
+            packets += 1
+            raw += len(data)
+            universes.add(universe)
+            sources.add(cid)
+        return {"packets": packets, "syncs": syncs, "universes": sorted(universes), "sources": len(sources),
+                "seconds": duration, "fileBytes": self.size, "channelBytes": raw}
+
+    def close(self):
+        self._map.close()
+
+
+class CaptureReplayer:
+    """
+    Feeds a capture into a sacnProxy's receive path, as if the packets had
+    just arrived, from a background thread.  speed scales the original timing
+    -- 1.0 for real time, 2.0 for twice as fast -- and 0 replays as fast as
+    the pipeline can take it.  With loop True, the capture repeats until
+    stop() is called.
+    """
+    speed = 1.0
+    loop = False
+
+    # statistics
+    packets = 0
+    passes = 0
+    seconds = 0            # time taken by the last complete pass
+
+    def __init__(self, proxy, filename, speed = 1.0, loop = False):
+        self.proxy = proxy
+        self.filename = filename
+        self.speed = max(0.0, speed)
+        self.loop = loop
+        self.done = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="capture-replay", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """Utility method: replay thread"""
+        reader = CaptureReader(self.filename)
+        onData = self.proxy.receive_callback()
+        onSync = self.proxy.assembler.sync
+        try:
+            while (not self._stopped.is_set()):
+                passStart = start = time.monotonic()
+                first = last = None
+                for t, kind, universe, syncAddr, sequence, priority, options, cid, data in reader.records():
+                    if (self._stopped.is_set()):
+                        break
+                    if (self.speed > 0):
+                        if ((first is None) or (t < last)):
+                            # start of the capture, or of a recording appended to it
+                            start = time.monotonic()
+                            first = t
+                        last = t
+                        delay = start + (t - first) / self.speed - time.monotonic()
+                        if ((delay > 0) and self._stopped.wait(delay)):
+                            break
+                    if (kind == RECORD_SYNC):
+                        onSync(syncAddr)
+                    else:
+                        onData(universe, data, sequence, priority, syncAddr, cid, options)
+                        self.packets += 1
+                else:
+                    self.seconds = time.monotonic() - passStart
+                    self.passes += 1
+                    if (self.loop):
+                        continue
+                break
+        except Exception as blarf:
+            template = "Replay of {0} halted by unexpected exception. Type: {1},  Args:\n{2!r}"
+            print(template.format(self.filename, type(blarf).__name__, blarf.args))
+        finally:
+            reader.close()
+            self.done.set()
+
+    def stop(self):
+        self._stopped.set()
+        if (self._thread is not None):
+            self._thread.join(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Record, inspect and decode E1.31 capture files")
+    parser.add_argument("command", choices=("record", "info", "decode"))
+    parser.add_argument("filename")
+    parser.add_argument("--universes", default="1-4", help="universes to record, e.g. 1-4 or 1,2,7")
+    parser.add_argument("--seconds", type=float, default=10, help="recording length")
+    parser.add_argument("--bind", default="0.0.0.0", help="address to receive on")
+    parser.add_argument("--raw", action="store_true", help="record without delta compression")
+    args = parser.parse_args()
+
+    if (args.command == "record"):
+        from e131receiver import E131Receiver
+        universes = set()
+        for part in args.universes.split(","):
+            a, sep, b = part.partition("-")
+            universes.update(range(int(a), int(b or a) + 1))
+        writer = CaptureWriter(args.filename, not args.raw)
+        rx = E131Receiver(args.bind)
+        rx.filterPriority = False          # keep every source, for merge testing
+        rx.listen(universes, writer.write, writer.write_sync)
+        for u in universes:
+            rx.join_multicast(u)
+        rx.start()
+        time.sleep(args.seconds)
+        rx.stop()
+        writer.close()
+        print("%d records, %d bytes of channel data in %d bytes" % (writer.records, writer.rawBytes,
+                                                                   writer.bytesWritten))
+    elif (args.command == "info"):
+        reader = CaptureReader(args.filename)
+        for k, v in reader.summary().items():
+            print("%-14s %s" % (k, v))
+        reader.close()
+    else:
+        reader = CaptureReader(args.filename)
+        t = time.perf_counter()
+        n = sum(1 for r in reader.records())
+        t = time.perf_counter() - t
+        reader.close()
+        print("%d records in %.3f s, %.0f records/sec" % (n, t, n / t))
@@ -0,0 +1,176 @@
+"""
+ discovery.py
+
+ Finds Pixelblazes on the local network, and remembers what it learned about
+ them between runs.
+
+ Every Pixelblaze broadcasts a small UDP beacon packet to port 1889 about once
+ a second: three little-endian 32-bit integers giving the packet type (42 for
+ a beacon), the sender's ID and the sender's clock.  discover() listens for
+ beacons and returns the address of each Pixelblaze heard.  BeaconEmulator
+ sends the same packets, so discovery can be tried without any hardware.
+
+ DeviceCache keeps each device's last known pixel count and configuration in
+ a JSON file, so that the proxy can start forwarding without waiting for every
+ Pixelblaze to answer, and check the details in the background.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import ipaddress
+import threading
+import socket
+import struct
+import json
+import time
+import os
+
+BEACON_PORT = 1889
+BEACON_PACKET = 42
+
+_BEACON = struct.Struct("<3L")
+
+
+def make_beacon(senderId, senderTime = None):
+    """Returns a Pixelblaze beacon packet"""
+    if (senderTime is None):
+        senderTime = int(time.monotonic() * 1000)
+    return _BEACON.pack(BEACON_PACKET, senderId & 0xffffffff, senderTime & 0xffffffff)
+
+
+def address_key(addr):
+    """Sort key that orders "a.b.c.d" or "a.b.c.d:port" addresses numerically"""
+    host, sep, port = addr.partition(":")
+    try:
+        return (0, int(ipaddress.ip_address(host)), int(port or 0))
+    except ValueError:
+        return (1, addr, 0)
+
+
+def discover(seconds = 2.0, expected = None, bindAddr = "", port = BEACON_PORT):
+    """
+    Listens for Pixelblaze beacons for up to <seconds> seconds, or until
+    <expected> devices have been heard.  Returns a dictionary mapping each
+    device's IP address to its sender ID.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if (hasattr(socket, "SO_REUSEPORT")):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((bindAddr, port))
+
+    devices = dict()
+    deadline = time.monotonic() + seconds
+    try:
+        while ((expected is None) or (len(devices) < expected)):
+            remaining = deadline - time.monotonic()
+            if (remaining <= 0):
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (addr, srcPort) = sock.recvfrom(64)
+            except socket.timeout:
+                break
+            if (len(data) >= _BEACON.size):
+                packetType, senderId, senderTime = _BEACON.unpack_from(data)
+                if (packetType == BEACON_PACKET):
+                    devices[addr] = senderId
+    finally:
+        sock.close()
+    return devices
+
+
+class BeaconEmulator:
+    """
+    Sends a beacon from each of the given source addresses to addr:port every
+    interval seconds, from a background thread.  On Linux, any 127.x.x.x
+    address can be used as a source, so one machine can pose as several
+    Pixelblazes.
+    """
+    interval = 1.0
+
+    def __init__(self, sources = ("127.0.0.1",), addr = "127.0.0.1", port = BEACON_PORT, interval = 1.0):
+        self.addr = addr
+        self.port = port
+        self.interval = interval
+        self._socks = []
+        for i, src in enumerate(sources):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            s.bind((src, 0))
+            self._socks.append((s, 0x1000 + i))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="beacon-emulator", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while (True):
+            for s, senderId in self._socks:
+                s.sendto(make_beacon(senderId), (self.addr, self.port))
+            if (self._stopped.wait(self.interval)):
+                break
+
+    def stop(self):
+        self._stopped.set()
+        if (self._thread is not None):
+            self._thread.join(1)
+        for s, senderId in self._socks:
+            s.close()
+
+
+class DeviceCache:
+    """
+    JSON file of the last known configuration of each Pixelblaze, keyed by
+    address.  Safe to update from several threads.  Updates re-read the file
+    first, so worker processes sharing it keep each other's entries.
+    """
+    filename = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.devices = self._load()
+
+    def _load(self):
+        """Utility method: returns the devices in the cache file, or an empty dictionary"""
+        try:
+            with open(self.filename, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def pixelCount(self, addr):
+        """Returns the cached pixel count for addr, or None if we've never seen it"""
+        entry = self.devices.get(addr)
+        return None if (entry is None) else entry.get("pixelCount")
+
+    def update(self, addr, config):
+        """Records a device's hardware configuration and rewrites the cache file"""
+        with self._lock:
+            self.devices.update(self._load())
+            self.devices[addr] = {"pixelCount": config.get("pixelCount"), "config": config, "updated": time.time()}
+            tmp = "%s.%d.tmp" % (self.filename, os.getpid())    # unique to this process
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(self.devices, f, indent=1, default=str)
+                os.replace(tmp, self.filename)
+            except OSError as err:
+                print("Unable to write device cache %s: %s" % (self.filename, err))
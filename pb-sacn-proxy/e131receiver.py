@@ -0,0 +1,346 @@
+"""
+ e131receiver.py
+
+ A lean E1.31 (sACN) receiver.  Datagrams are read with recv_into() into a
+ single preallocated buffer, the root, framing and DMP layer headers are
+ parsed in place with struct.unpack_from, and the DMX data is handed to the
+ callback as a memoryview slice of the receive buffer -- no per-packet
+ packet objects or data tuples.  The callback must finish with the data
+ before it returns, since the next datagram overwrites it.
+
+ Unlike the sacn module, this receiver also delivers E1.31 synchronization
+ packets, and passes every valid data packet through whether or not its
+ contents have changed.
+
+ Run this file directly for a loopback benchmark of this receiver against
+ the sacn module's.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import socket
+import struct
+import sys
+import threading
+import time
+
+E131_PORT = 5568
+ACN_PACKET_ID = b'ASC-E1.17\0\0\0'
+
+VECTOR_ROOT_E131_DATA = 0x00000004
+VECTOR_ROOT_E131_EXTENDED = 0x00000008
+VECTOR_E131_DATA_PACKET = 0x00000002
+VECTOR_E131_EXTENDED_SYNCHRONIZATION = 0x00000001
+VECTOR_DMP_SET_PROPERTY = 0x02
+
+OPTION_PREVIEW_DATA = 0x80
+OPTION_STREAM_TERMINATED = 0x40
+
+SOURCE_TIMEOUT = 2.5        # E1.31 network data loss timeout, seconds
+MAX_PACKET = 638            # largest legal E1.31 data packet
+
+# root layer: preamble size, postamble size, ACN packet id, flags & length, vector, CID
+_ROOT = struct.Struct("!HH12sHI16s")
+# data packet framing layer: flags & length, vector, source name, priority,
+# sync address, sequence, options, universe
+_FRAMING = struct.Struct("!HI64sBHBBH")
+# DMP layer: flags & length, vector, address & data type, first address,
+# increment, property value count, start code
+_DMP = struct.Struct("!HBBHHHB")
+# sync packet framing layer: flags & length, vector, sequence, sync address
+_SYNC = struct.Struct("!HIBH")
+# the root and framing layers as parsed: the same layouts, but skipping the
+# byte strings, so receiving a packet doesn't copy them
+_ROOT_IN = struct.Struct("!HH12xHI16x")
+_FRAMING_IN = struct.Struct("!HI64xBHBBH")
+
+_FRAMING_OFS = _ROOT.size                    # 38
+_DMP_OFS = _FRAMING_OFS + _FRAMING.size      # 115
+_DATA_OFS = _DMP_OFS + _DMP.size             # 126
+
+
+def multicast_addr(universe):
+    """Returns the E1.31 multicast group address for a universe"""
+    return "239.255.%d.%d" % (universe >> 8, universe & 0xff)
+
+
+def make_packet(universe, data, sequence = 0, priority = 100, syncAddr = 0, options = 0,
+                cid = b'pb-sacn-proxy\0\0\0', sourceName = "pb-sacn-proxy"):
+    """Builds an E1.31 data packet, as bytes, carrying data (up to 512 channels)"""
+    data = bytes(data[:512])
+    n = len(data)
+    pkt = _ROOT.pack(0x0010, 0, ACN_PACKET_ID, 0x7000 | (n + 110), VECTOR_ROOT_E131_DATA, cid)
+    pkt += _FRAMING.pack(0x7000 | (n + 88), VECTOR_E131_DATA_PACKET, sourceName.encode("utf-8")[:63],
+                         priority, syncAddr, sequence & 0xff, options, universe)
+    pkt += _DMP.pack(0x7000 | (n + 11), VECTOR_DMP_SET_PROPERTY, 0xa1, 0, 1, n + 1, 0)
+    return pkt + data
+
+
+def make_sync_packet(syncAddr, sequence = 0, cid = b'pb-sacn-proxy\0\0\0'):
+    """Builds an E1.31 synchronization packet"""
+    return (_ROOT.pack(0x0010, 0, ACN_PACKET_ID, 0x7000 | 33, VECTOR_ROOT_E131_EXTENDED, cid) +
+            _SYNC.pack(0x7000 | 11, VECTOR_E131_EXTENDED_SYNCHRONIZATION, sequence & 0xff, syncAddr) +
+            b'\0\0')
+
+
+class E131Receiver:
+    """
+    Receives E1.31 data and sync packets on a background thread.
+    onData(universe, data, sequence, priority, syncAddr, cid, options) is
+    called for each valid data packet on a universe we're listening to,
+    with data and cid as memoryview slices of the receive buffer.
+    onSync(syncAddr) is called for each synchronization packet.
+
+    Sequence numbers are checked per source.  By default, only the highest
+    priority source of each universe is passed on.  With filterPriority
+    False, every source's packets are passed on, including the final
+    packet of a terminated stream, for a SourceMerger (see merge.py) to sort
+    out.
+    """
+    bindAddr = "0.0.0.0"
+    port = E131_PORT
+    running = False
+    filterPriority = True
+
+    # statistics
+    packets = 0
+    invalid = 0
+    outOfOrder = 0
+    lowPriority = 0
+    ignored = 0          # valid packets for universes we don't want
+    tracer = None        # optional FrameTracer
+
+    def __init__(self, bindAddr = "0.0.0.0", port = E131_PORT):
+        self.bindAddr = bindAddr
+        self.port = port
+        self.onData = None
+        self.onSync = None
+        self._universes = frozenset()
+        self._sequence = dict()    # cid -> {universe: last accepted sequence number}
+        self._cid = None           # bytes of the last CID seen, to key _sequence without copying
+        self._priority = dict()    # universe -> (priority, time.monotonic())
+        self._buffer = bytearray(MAX_PACKET)
+        self._view = memoryview(self._buffer)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        except OSError:
+            pass
+        # Windows needs the interface address to receive multicast; other
+        # platforms must bind the wildcard address instead.
+        self.sock.bind((bindAddr if (sys.platform == "win32") else "", port))
+        self.sock.settimeout(0.25)
+        self._thread = None
+
+    def listen(self, universes, onData, onSync = None):
+        """Sets the universes we care about and the packet callbacks"""
+        self._universes = frozenset(universes)
+        self.onData = onData
+        self.onSync = onSync
+
+    def join_multicast(self, universe):
+        mreq = socket.inet_aton(multicast_addr(universe)) + socket.inet_aton(self.bindAddr)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="e131-receiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        if (self._thread is not None):
+            self._thread.join(1)
+        self.sock.close()
+
+    def _run(self):
+        """Utility method: receiver thread"""
+        recv_into = self.sock.recv_into
+        buf = self._buffer
+        while (self.running):
+            try:
+                n = recv_into(buf)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if (self.tracer is None):
+                self.parse(n)
+            else:
+                t = self.tracer.now()
+                self.parse(n)
+                self.tracer.span("receive", t)
+
+    def parse(self, n):
+        """
+        Utility method: validates the n byte datagram in the receive buffer and
+        dispatches it.  Returns True if it was delivered to a callback.
+        """
+        buf = self._buffer
+        view = self._view
+        if (n < _FRAMING_OFS + _SYNC.size):
+            self.invalid += 1
+            return False
+        (preamble, postamble, rootFlen, rootVector) = _ROOT_IN.unpack_from(buf, 0)
+        if ((preamble != 0x0010) or (view[4:16] != ACN_PACKET_ID)):
+            self.invalid += 1
+            return False
+
+        if (rootVector == VECTOR_ROOT_E131_EXTENDED):
+            (flen, vector, sequence, syncAddr) = _SYNC.unpack_from(buf, _FRAMING_OFS)
+            if ((vector == VECTOR_E131_EXTENDED_SYNCHRONIZATION) and (self.onSync is not None)):
+                self.packets += 1
+                self.onSync(syncAddr)
+                return True
+            self.ignored += 1
+            return False
+
+        if ((rootVector != VECTOR_ROOT_E131_DATA) or (n < _DATA_OFS)):
+            self.invalid += 1
+            return False
+
+        (flen, vector, priority, syncAddr, sequence, options, universe) = _FRAMING_IN.unpack_from(buf, _FRAMING_OFS)
+        if ((vector != VECTOR_E131_DATA_PACKET) or (universe < 1) or (universe > 63999) or (priority > 200)):
+            self.invalid += 1
+            return False
+        if ((universe not in self._universes) or (options & OPTION_PREVIEW_DATA)):
+            self.ignored += 1
+            return False
+
+        (flen, dmpVector, addrType, first, incr, count, startCode) = _DMP.unpack_from(buf, _DMP_OFS)
+        if ((dmpVector != VECTOR_DMP_SET_PROPERTY) or (addrType != 0xa1) or (count < 1) or (count > 513)):
+            self.invalid += 1
+            return False
+        if (startCode != 0):      # alternate start codes, per-channel priority, etc.
+            self.ignored += 1
+            return False
+
+        # sources send runs of packets, so the CID is usually the last one's
+        cid = view[22:38]
+        if (cid != self._cid):
+            self._cid = cid.tobytes()
+        sequences = self._sequence.get(self._cid)
+        if (sequences is None):
+            sequences = self._sequence[self._cid] = dict()
+
+        # stream termination: forget the source, so its replacement isn't
+        # rejected as out of order or low priority
+        if (options & OPTION_STREAM_TERMINATED):
+            sequences.pop(universe, None)
+            if (self.filterPriority):
+                self._priority.pop(universe, None)
+                self.ignored += 1
+                return False
+            self.onData(universe, view[_DATA_OFS:_DATA_OFS], sequence, priority, syncAddr, cid, options)
+            return True
+
+        # priority: the highest priority source wins until it times out
+        if (self.filterPriority):
+            now = time.monotonic()
+            best = self._priority.get(universe)
+            if ((best is None) or (priority >= best[0]) or (now - best[1] > SOURCE_TIMEOUT)):
+                self._priority[universe] = (priority, now)
+            else:
+                self.lowPriority += 1
+                return False
+
+        # sequence: discard if -20 < (new - last) <= 0, modulo 256
+        last = sequences.get(universe)
+        if (last is not None):
+            diff = (sequence - last) & 0xff
+            if ((diff == 0) or (diff > 236)):
+                self.outOfOrder += 1
+                return False
+        sequences[universe] = sequence
+
+        self.packets += 1
+        end = min(n, _DATA_OFS + count - 1)
+        self.onData(universe, view[_DATA_OFS:end], sequence, priority, syncAddr, cid, options)
+        return True
+
+
+def _blast(port, packets, seconds):
+    """Benchmark helper: sends packets to port on loopback as fast as possible"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stop = time.monotonic() + seconds
+    while (time.monotonic() < stop):
+        for p in packets:
+            s.sendto(p, ("127.0.0.1", port))
+
+
+if __name__ == "__main__":
+    import multiprocessing
+    from pixelpack import PixelPacker
+    from universemap import UniverseMap
+
+    universes = 4
+    seconds = 3
+    segs = UniverseMap.default(universes, 170).compile()
+    packer = PixelPacker(universes * 170)
+
+    # many distinct frames, so the sacn module's change detection can't skip any
+    packets = [make_packet(u, bytes((f + u + i) & 0xff for i in range(510)), f)
+               for f in range(64) for u in range(1, universes + 1)]
+
+    def bench(name, port, start, stop):
+        count = [0]
+        start(count)
+        sender = multiprocessing.Process(target=_blast, args=(port, packets, seconds))
+        sender.start()
+        sender.join()
+        time.sleep(0.2)
+        stop()
+        print("%-8s %10.0f packets/sec" % (name, count[0] / seconds))
+
+    def native_start(count):
+        global rx
+        rx = E131Receiver("127.0.0.1", 5600)
+
+        def onData(universe, data, sequence, priority, syncAddr, cid, options):
+            for seg in segs[universe]:
+                packer.pack_segment(data, seg)
+            count[0] += 1
+
+        rx.listen(segs.keys(), onData)
+        rx.start()
+
+    bench("native", 5600, native_start, lambda: rx.stop())
+
+    try:
+        import sacn
+    except ImportError:
+        sacn = None
+        print("sacn     not installed")
+
+    if (sacn is not None):
+        def sacn_start(count):
+            global srx
+            srx = sacn.sACNreceiver(bind_address="127.0.0.1", bind_port=5601)
+
+            def onPacket(packet):
+                for seg in segs[packet.universe]:
+                    packer.pack_segment(packet.dmxData, seg)
+                count[0] += 1
+
+            for u in segs:
+                srx.listen_on('universe', universe=u)(onPacket)
+            srx.start()
+
+        bench("sacn", 5601, sacn_start, lambda: srx.stop())
@@ -0,0 +1,230 @@
+"""
+ frameencoder.py
+
+ Fast serialization of pixel frames into setVars messages.  Rather than
+ building a dict, running it through json.dumps and encoding the resulting
+ string, we keep a ready-made bytes template for each frame size, with the
+ {"setVars":{"pixels":[ prefix and ]}} suffix already in place, and fill it
+ with a single bytes % operation.
+
+ Values are written with four decimal places.  The packed pixel values are
+ multiples of 1/256, and Pixelblaze stores numbers as 16.16 fixed point, so
+ four places is enough for every value to land on exactly the right fixed
+ point number after the listener pattern's rounding, and is usually shorter
+ than Python's full float repr.
+
+ Run this file directly to compare the encoder with the json.dumps path.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from pixelpack import numpy, HAVE_NUMPY, _SCALE, R_OFS, G_OFS, B_OFS
+import sys
+
+# RGB565 packing tables.  The high byte of a 565 pixel is rrrrrggg, the
+# low byte gggbbbbb.
+_R565 = bytes(i & 0xf8 for i in range(256))
+_G565HI = bytes(i >> 5 for i in range(256))
+_G565LO = bytes((i << 3) & 0xe0 for i in range(256))
+_B565 = bytes(i >> 3 for i in range(256))
+
+# byte offsets, within a native 32-bit word, of the first pixel's high and
+# low bytes and the second pixel's high and low bytes
+if (sys.byteorder == "little"):
+    _PAIR_OFS = (3, 2, 1, 0)
+else:
+    _PAIR_OFS = (0, 1, 2, 3)
+
+# Two 565 pixels fill all 32 bits of a 16.16 value, so the number has to
+# arrive at exactly the right fixed point value.  We send it a quarter step
+# high, so that it comes out right whether Pixelblaze rounds or truncates.
+_SCALE565 = (1 / 65536).__mul__
+_OFFSET565 = (0.25 / 65536).__add__
+
+
+class FrameEncoder:
+    """
+    Encodes packed pixel words (see pixelpack.py) as a complete setVars
+    message for a single exported array variable.
+    """
+    varName = "pixels"
+    precision = 4
+    useNumpy = HAVE_NUMPY
+
+    def __init__(self, varName = "pixels", precision = 4, useNumpy = None):
+        self.varName = varName
+        self.precision = precision
+        if (useNumpy is not None):
+            self.useNumpy = useNumpy and HAVE_NUMPY
+        self._prefix = ('{"setVars":{"%s":[' % varName).encode("utf-8")
+        self._suffix = b']}}'
+        self._number = ('%%.%df' % precision).encode("utf-8")
+        self._templates = dict()
+
+    def template(self, count):
+        """Returns the cached bytes format string for a frame of count values"""
+        fmt = self._templates.get(count)
+        if (fmt is None):
+            fmt = self._prefix + b','.join([self._number] * count) + self._suffix
+            self._templates[count] = fmt
+        return fmt
+
+    def values(self, words, count, start = 0):
+        """Utility method: returns a tuple of count scaled pixel values from words"""
+        end = min(start + count, len(words) // 4)
+        if (self.useNumpy):
+            return tuple((numpy.frombuffer(words, dtype=numpy.int32)[start:end] * (1 / 256)).tolist())
+        return tuple(map(_SCALE, memoryview(words).cast('i')[start:end]))
+
+    def encode(self, words, count, start = 0):
+        """
+        Returns the complete setVars message, as UTF-8 bytes, for count pixels
+        of words beginning at pixel start.
+        """
+        vals = self.values(words, count, start)
+        return self.template(len(vals)) % vals
+
+
+class Rgb565Encoder(FrameEncoder):
+    """
+    Compact encoding for the RGB565 SACN Listener pattern.  Each exported value
+    carries two pixels in RGB565 format -- the first in the integer part, the
+    second in the fractional part -- roughly halving the size of each frame.
+    """
+    varName = "pixels565"
+    precision = 6
+
+    def __init__(self, varName = "pixels565", useNumpy = None):
+        super().__init__(varName, 6, useNumpy)
+
+    def values(self, words, count, start = 0):
+        """Utility method: returns a tuple of (count + 1) // 2 pixel pair values"""
+        end = min(start + count, len(words) // 4)
+        n = end - start
+        if (n <= 0):
+            return ()
+
+        if (self.useNumpy):
+            px = numpy.frombuffer(words, dtype=numpy.uint8).reshape(-1, 4)[start:end].astype(numpy.int64)
+            c = ((px[:, R_OFS] & 0xf8) << 8) | ((px[:, G_OFS] & 0xfc) << 3) | (px[:, B_OFS] >> 3)
+            if (n & 1):
+                c = numpy.append(c, 0)
+            v = (c[0::2] << 16) | c[1::2]
+            v = numpy.where(v >= 0x80000000, v - 0x100000000, v)
+            return tuple(((v + 0.25) * (1 / 65536)).tolist())
+
+        src = bytes(words[4 * start:4 * end])
+        red, green, blue = src[R_OFS::4], src[G_OFS::4], src[B_OFS::4]
+        hi = bytes(map(int.__or__, red.translate(_R565), green.translate(_G565HI)))
+        lo = bytes(map(int.__or__, green.translate(_G565LO), blue.translate(_B565)))
+        if (n & 1):
+            hi += b'\0'
+            lo += b'\0'
+        pairs = bytearray(2 * len(hi))
+        pairs[_PAIR_OFS[0]::4] = hi[0::2]
+        pairs[_PAIR_OFS[1]::4] = lo[0::2]
+        pairs[_PAIR_OFS[2]::4] = hi[1::2]
+        pairs[_PAIR_OFS[3]::4] = lo[1::2]
+        return tuple(map(_OFFSET565, map(_SCALE565, memoryview(pairs).cast('i'))))
+
+
+class ChunkedEncoder(FrameEncoder):
+    """
+    Encoding for the Chunked SACN Listener pattern, which splits its pixel
+    buffer into arrays of chunkSize pixels named pixels0, pixels1, ...
+    encode_chunks() sends any subset of the chunks in a single message.
+    """
+    chunkSize = 128
+    chunkCount = 8
+
+    def __init__(self, chunkSize = 128, chunkCount = 8, varName = "pixels", useNumpy = None):
+        super().__init__(varName, 4, useNumpy)
+        self.chunkSize = max(1, chunkSize)
+        self.chunkCount = max(1, chunkCount)
+        self._chunkTemplates = dict()
+
+    def chunk_template(self, index, count):
+        """Returns the cached format string for chunk <index> holding count values"""
+        key = (index, count)
+        fmt = self._chunkTemplates.get(key)
+        if (fmt is None):
+            fmt = ('"%s%d":[' % (self.varName, index)).encode("utf-8") + b','.join([self._number] * count) + b']'
+            self._chunkTemplates[key] = fmt
+        return fmt
+
+    def encode_chunks(self, words, count, start = 0, chunks = None):
+        """
+        Returns a setVars message containing the listed chunk indices (all
+        chunks if chunks is None) of the count pixels beginning at start.
+        """
+        count = min(count, self.chunkSize * self.chunkCount)
+        if (chunks is None):
+            chunks = range((count + self.chunkSize - 1) // self.chunkSize)
+        parts = []
+        for i in chunks:
+            first = i * self.chunkSize
+            vals = self.values(words, min(self.chunkSize, count - first), start + first)
+            parts.append(self.chunk_template(i, len(vals)) % vals)
+        return b'{"setVars":{' + b','.join(parts) + b'}}'
+
+    def encode(self, words, count, start = 0):
+        return self.encode_chunks(words, count, start)
+
+
+if __name__ == "__main__":
+    import json
+    import random
+    import time
+    from pixelpack import PixelPacker
+
+    pixelCount = 680
+    frames = 2000
+    packer = PixelPacker(pixelCount)
+    for u in range(4):
+        packer.pack(tuple(random.randrange(256) for i in range(512)), u * 170, 170)
+    words = bytes(packer.words)
+
+    def legacy(words, count):
+        # the setVariable -> setVars -> send_string path
+        val = {"pixels": packer.values(count)}
+        jstr = json.dumps(val)
+        return ('{"setVars" : ' + jstr + "}").encode("utf-8")
+
+    def bench(name, fn):
+        t = time.perf_counter()
+        for f in range(frames):
+            data = fn(words, pixelCount)
+        t = time.perf_counter() - t
+        print("%-16s %8.0f frames/sec  %6d bytes/frame" % (name, frames / t, len(data)))
+        return data
+
+    ref = json.loads(bench("json.dumps", legacy))["setVars"]["pixels"]
+    paths = [("encoder", FrameEncoder(useNumpy=False))]
+    if (HAVE_NUMPY):
+        paths.append(("encoder (numpy)", FrameEncoder(useNumpy=True)))
+    for name, enc in paths:
+        out = json.loads(bench(name, enc.encode))["setVars"]["pixels"]
+        # every value must round to the same 8 fractional bits the listener unpacks
+        if (any(round(a * 256) != round(b * 256) for a, b in zip(ref, out))):
+            print("%s output does not match json.dumps!" % name)
+
+    paths = [("rgb565", Rgb565Encoder(useNumpy=False))]
+    if (HAVE_NUMPY):
+        paths.append(("rgb565 (numpy)", Rgb565Encoder(useNumpy=True)))
+    for name, enc in paths:
+        bench(name, enc.encode)
@@ -0,0 +1,99 @@
+"""
+ framestore.py
+
+ Hands frames from the receiver thread to the output threads without
+ tearing, and without copying while holding a lock.
+
+ The store is a generalized triple buffer.  With N readers it preallocates
+ N + 2 frame buffers: one holding the latest published frame, one held by
+ each reader, and at least one free buffer for the writer to fill.  The
+ writer copies a new frame into a free buffer, then publishes it by swapping
+ a single index.  A reader acquires the latest frame by taking that index,
+ and holds it -- the writer won't touch it -- until the reader's next
+ acquire().  Only the index bookkeeping happens under the lock.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import threading
+import time
+
+
+class FrameStore:
+    """
+    Single writer, multiple reader frame store with preallocated buffers.
+    Frames are numbered from 1 as they're published.
+    """
+    size = 0
+    published = 0      # frames published by the writer
+    overwritten = 0    # frames replaced before a reader got to them, summed over readers
+    lost = 0           # frames a reader acquired but discarded without sending
+
+    def __init__(self, size, readers = 1):
+        """Creates a store for frames of size bytes, shared by <readers> readers"""
+        self.size = size
+        self._lock = threading.Lock()
+        self._buffers = [bytearray(size) for i in range(readers + 2)]
+        self._times = [0.0] * len(self._buffers)
+        self._seqs = [0] * len(self._buffers)
+        self._latest = None
+        self._held = [None] * readers     # buffer index held by each reader
+        self._lastSeq = [0] * readers     # last frame number acquired by each reader
+
+    def publish(self, frame, frameTime = None):
+        """
+        Copies frame (any bytes-like object of the store's size) into a free
+        buffer and makes it the latest frame.  Must only be called by one
+        thread at a time.
+        """
+        with self._lock:
+            busy = set(self._held)
+            busy.add(self._latest)
+            idx = next(i for i in range(len(self._buffers)) if (i not in busy))
+
+        # nobody else can see this buffer until we publish it
+        self._buffers[idx][:] = frame
+        self._times[idx] = time.monotonic() if (frameTime is None) else frameTime
+
+        with self._lock:
+            self.published += 1
+            self._seqs[idx] = self.published
+            self._latest = idx
+
+    def acquire(self, reader):
+        """
+        Releases the reader's previous frame and returns (buffer, frameNumber,
+        frameTime) for the latest frame, or (None, 0, 0) if nothing has been
+        published yet.  The buffer stays valid until the reader's next acquire().
+        Acquiring the same frame twice is allowed, e.g. for a keepalive resend.
+        """
+        with self._lock:
+            idx = self._latest
+            self._held[reader] = idx
+            if (idx is None):
+                return (None, 0, 0)
+            seq = self._seqs[idx]
+            skipped = seq - self._lastSeq[reader] - 1
+            if (skipped > 0):
+                self.overwritten += skipped
+            self._lastSeq[reader] = max(seq, self._lastSeq[reader])
+        return (self._buffers[idx], seq, self._times[idx])
+
+    def discard(self, reader):
+        """Called by a reader that acquired a frame but won't send it"""
+        self.lost += 1
@@ -0,0 +1,280 @@
+"""
+ merge.py
+
+ Merges E1.31 data from several sources sending the same universe -- two
+ consoles, or a main and a backup lightshowpi -- instead of letting whichever
+ packet arrived last win.
+
+ Sources are told apart by CID.  As E1.31 specifies, only the sources with
+ the highest priority are used, and a source that stops sending, or
+ terminates its stream, drops out; after SOURCE_TIMEOUT seconds of silence,
+ lower priority sources take over automatically.  When several sources
+ share the top priority, their levels are merged per channel, either HTP
+ (highest takes precedence) or LTP (latest change takes precedence).
+
+ Each source's levels are kept as a row of a per-universe buffer, so a merge
+ is a single batched operation over the rows -- a NumPy reduction or, without
+ NumPy, big integer arithmetic on all 512 channels at once -- rather than a
+ loop per channel.  A universe with only one active source skips merging
+ altogether.
+
+ Run this file directly for a quick benchmark.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from pixelpack import numpy, HAVE_NUMPY
+from e131receiver import SOURCE_TIMEOUT, OPTION_STREAM_TERMINATED
+import time
+
+MERGE_HTP = "htp"
+MERGE_LTP = "ltp"
+
+_CHANNELS = 512
+
+# Without NumPy, a universe's levels are widened into a single integer with a
+# 16 bit lane per channel, so that lane-wise compares can borrow into the
+# spare high byte of each lane without disturbing the next channel.
+_LANE_ONES = int.from_bytes(b'\1\0' * _CHANNELS, "little")
+_LANE_BIAS = _LANE_ONES << 8
+_LANE_LOW = _LANE_ONES * 0xff
+
+
+def _widen(levels):
+    """Utility function: up to 512 levels as an integer with a 16 bit lane per channel"""
+    w = bytearray(2 * _CHANNELS)
+    w[0:2 * len(levels):2] = levels
+    return int.from_bytes(w, "little")
+
+
+def _narrow(lanes):
+    """Utility function: the inverse of _widen()"""
+    return lanes.to_bytes(2 * _CHANNELS, "little")[0::2]
+
+
+def _lane_max(a, b):
+    """Utility function: lane-wise maximum of two widened level sets"""
+    # a lane of (a + 256 - b) has bit 8 set where a >= b
+    keepA = (((a + _LANE_BIAS - b) >> 8) & _LANE_ONES) * 0xff
+    return (a & keepA) | (b & (_LANE_LOW ^ keepA))
+
+
+def _lane_changed(a, b):
+    """Utility function: 0xff in each lane where a and b differ, 0 elsewhere"""
+    return ((((a ^ b) + _LANE_LOW) >> 8) & _LANE_ONES) * 0xff
+
+
+class _Source:
+    """Utility class: what we know about one source of one universe"""
+    __slots__ = ("cid", "priority", "lastSeen", "row", "length")
+
+    def __init__(self, cid, row):
+        self.cid = cid
+        self.row = row
+        self.priority = 0
+        self.lastSeen = 0
+        self.length = 0
+
+
+class _Universe:
+    """Utility class: a universe's sources, their levels and the merged result"""
+
+    def __init__(self, maxSources, useNumpy):
+        self.sources = dict()          # cid -> _Source
+        self.freeRows = list(range(maxSources - 1, -1, -1))
+        self.levels = bytearray(maxSources * _CHANNELS)
+        self.merged = bytearray(_CHANNELS)
+        self.lead = None               # cid of the source whose packets drive frame timing
+        self.contenders = None         # cids merged last time, so LTP can start afresh when they change
+        if (useNumpy):
+            self.levelArray = numpy.frombuffer(self.levels, dtype=numpy.uint8).reshape(maxSources, _CHANNELS)
+            self.mergedArray = numpy.frombuffer(self.merged, dtype=numpy.uint8)
+
+    def row(self, src):
+        a = src.row * _CHANNELS
+        return memoryview(self.levels)[a:a + _CHANNELS]
+
+
+class SourceMerger:
+    """
+    Tracks the sources of each universe and merges their levels.  receive()
+    is called from the receiver thread for every data packet.
+    """
+    mode = MERGE_HTP
+    maxSources = 8          # per universe
+    timeout = SOURCE_TIMEOUT
+    useNumpy = HAVE_NUMPY
+
+    # statistics
+    merges = 0              # packets that needed a merge
+    lowPriority = 0         # packets from sources outranked by a higher priority source
+    rejected = 0            # packets from new sources when a universe already had maxSources
+    terminated = 0          # sources that ended their stream
+    timedOut = 0            # sources dropped after falling silent
+
+    def __init__(self, mode = MERGE_HTP, maxSources = 8, useNumpy = None):
+        mode = mode.lower()
+        if (mode not in (MERGE_HTP, MERGE_LTP)):
+            raise ValueError("Unsupported merge mode: %s" % mode)
+        self.mode = mode
+        self.maxSources = max(1, maxSources)
+        if (useNumpy is not None):
+            self.useNumpy = bool(useNumpy) and HAVE_NUMPY
+        self._universes = dict()
+
+    def sourceCount(self):
+        """Returns the number of sources currently known, over all universes"""
+        return sum(len(u.sources) for u in list(self._universes.values()))
+
+    def receive(self, universe, cid, data, priority, options = 0, now = None):
+        """
+        Accepts a data packet from the source cid.  Returns (levels, lead):
+        levels is the universe's merged data, or None if the packet doesn't
+        change what we send -- for example because a higher priority source
+        is active.  lead is True if this source drives the universe's frame
+        timing: when several sources are merged, only one of them should
+        mark the universe as received, or the frame rate would multiply.
+        The returned levels are only valid until the next call.
+        """
+        if (now is None):
+            now = time.monotonic()
+        cid = bytes(cid)
+        u = self._universes.get(universe)
+        if (u is None):
+            u = self._universes[universe] = _Universe(self.maxSources, self.useNumpy)
+
+        self._expire(u, now)
+        src = u.sources.get(cid)
+        if (options & OPTION_STREAM_TERMINATED):
+            if (src is not None):
+                self.terminated += 1
+                self._remove(u, src)
+            return None, False
+
+        if (src is None):
+            if (not u.freeRows):
+                self.rejected += 1
+                return None, False
+            src = u.sources[cid] = _Source(cid, u.freeRows.pop())
+        src.priority = priority
+        src.lastSeen = now
+
+        top = max(s.priority for s in u.sources.values())
+        if (priority < top):
+            # keep the levels, so we're ready if the higher priority source goes away
+            self._store(u, src, data)
+            self.lowPriority += 1
+            return None, False
+
+        contenders = [s for s in u.sources.values() if (s.priority == top)]
+        if ((u.lead is None) or (u.lead not in u.sources) or (u.sources[u.lead].priority < top)):
+            u.lead = cid
+        if (len(contenders) == 1):
+            self._store(u, src, data)
+            u.contenders = None
+            return u.row(src)[:src.length], True
+
+        self.merges += 1
+        if (self.mode == MERGE_HTP):
+            self._store(u, src, data)
+            self._merge_htp(u, contenders)
+        else:
+            key = frozenset(s.cid for s in contenders)
+            if (u.contenders != key):
+                # a source joined or left: the latest packet sets every channel
+                u.contenders = key
+                self._store(u, src, data)
+                u.merged[:] = u.row(src)
+            else:
+                self._merge_ltp(u, src, data)
+        return memoryview(u.merged)[:max(s.length for s in contenders)], (u.lead == cid)
+
+    def _store(self, u, src, data):
+        """Utility method: copies a packet's levels into its source's row, zero filling the rest"""
+        n = min(len(data), _CHANNELS)
+        row = u.row(src)
+        row[:n] = data[:n]
+        if (src.length > n):
+            row[n:src.length] = bytes(src.length - n)
+        src.length = n
+
+    def _merge_htp(self, u, contenders):
+        """Utility method: highest level of any contender, for every channel at once"""
+        if (self.useNumpy):
+            numpy.maximum.reduce(u.levelArray[[s.row for s in contenders]], axis=0, out=u.mergedArray)
+        else:
+            lanes = _widen(u.row(contenders[0]))
+            for s in contenders[1:]:
+                lanes = _lane_max(lanes, _widen(u.row(s)))
+            u.merged[:] = _narrow(lanes)
+
+    def _merge_ltp(self, u, src, data):
+        """Utility method: the channels this packet changes take its levels"""
+        old = bytes(u.row(src))
+        self._store(u, src, data)
+        new = u.row(src)
+        if (self.useNumpy):
+            a = numpy.frombuffer(old, dtype=numpy.uint8)
+            b = numpy.frombuffer(new, dtype=numpy.uint8)
+            changed = (a != b)
+            u.mergedArray[changed] = b[changed]
+        else:
+            b = _widen(new)
+            changed = _lane_changed(_widen(old), b)
+            u.merged[:] = _narrow((b & changed) | (_widen(u.merged) & (_LANE_LOW ^ changed)))
+
+    def _expire(self, u, now):
+        """Utility method: drops sources we haven't heard from in timeout seconds"""
+        for src in [s for s in u.sources.values() if (now - s.lastSeen > self.timeout)]:
+            self.timedOut += 1
+            self._remove(u, src)
+
+    def _remove(self, u, src):
+        del u.sources[src.cid]
+        u.levels[src.row * _CHANNELS:(src.row + 1) * _CHANNELS] = bytes(_CHANNELS)
+        u.freeRows.append(src.row)
+        if (u.lead == src.cid):
+            u.lead = None
+
+
+if __name__ == "__main__":
+    import random
+
+    universes = 16
+    sources = 3
+    seconds = 1.0
+    cids = [("source %d" % i).encode().ljust(16, b'\0') for i in range(sources)]
+    frames = [[bytes(random.randrange(256) for c in range(510)) for u in range(universes)] for f in range(8)]
+
+    def bench(name, merger, cids):
+        n = 0
+        start = time.perf_counter()
+        while (time.perf_counter() - start < seconds):
+            levels = frames[n % len(frames)]
+            for u in range(universes):
+                for cid in cids:
+                    merger.receive(u + 1, cid, levels[(u + n) % universes], 100)
+            n += 1
+        t = time.perf_counter() - start
+        print("%-22s %10.0f packets/sec" % (name, n * universes * len(cids) / t))
+
+    bench("single source", SourceMerger(), cids[:1])
+    for useNumpy in ((False, True) if (HAVE_NUMPY) else (False,)):
+        for mode in (MERGE_HTP, MERGE_LTP):
+            bench("%d sources, %s%s" % (sources, mode, ", numpy" if (useNumpy) else ""),
+                  SourceMerger(mode, useNumpy=useNumpy), cids)
@@ -0,0 +1,168 @@
+"""
+ metrics.py
+
+ Runtime metrics for the proxy.  sacnProxy.getMetrics() returns a snapshot
+ of every counter as a dictionary; MetricsServer publishes the same snapshot
+ over HTTP, in Prometheus text format at /metrics and as JSON at
+ /metrics.json, so that a controller falling behind during a show can be
+ spotted from a dashboard.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import bisect
+import json
+
+# upper bounds, in seconds, of the send duration histogram buckets
+SEND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram.  observe() is cheap enough to call for every frame,
+    and is only ever called from one thread.
+    """
+
+    def __init__(self, bounds = SEND_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)   # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """Returns {"buckets": [(upperBound, cumulativeCount), ...], "sum", "count"}"""
+        buckets = []
+        total = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            total += n
+            buckets.append((bound, total))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+def _labels(**labels):
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels.items()) + "}"
+
+
+def render_prometheus(snapshot):
+    """Formats a sacnProxy.getMetrics() snapshot in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append("# HELP pbsacn_%s %s" % (name, help))
+        lines.append("# TYPE pbsacn_%s %s" % (name, kind))
+        for labels, value in samples:
+            if (value is not None):
+                lines.append("pbsacn_%s%s %s" % (name, labels, value if isinstance(value, int) else repr(float(value))))
+
+    rx = snapshot["receiver"]
+    metric("packets_total", "counter", "E1.31 data packets accepted, by universe",
+           [(_labels(universe=u), n) for u, n in sorted(rx["packets"].items())])
+    for key, name, help in (("framesAssembled", "frames_assembled_total", "Frames assembled from incoming universes"),
+                            ("incomplete", "frames_incomplete_total", "Frames published with universes missing"),
+                            ("late", "packets_late_total", "Packets that arrived after their frame was published"),
+                            ("outOfOrder", "packets_out_of_order_total", "Packets discarded by the sequence check"),
+                            ("invalid", "packets_invalid_total", "Malformed packets (built-in receiver only)")):
+        metric(name, "counter", help, [("", rx.get(key))])
+    metric("incoming_fps", "gauge", "Frames assembled per second", [("", rx["fps"])])
+    if ("sources" in rx):
+        metric("sources", "gauge", "Active E1.31 sources, summed over universes", [("", rx["sources"])])
+        for key, name, help in (("merges", "merges_total", "Packets merged with other sources' levels"),
+                                ("lowPriority", "packets_low_priority_total", "Packets outranked by a higher priority source"),
+                                ("sourcesTimedOut", "sources_timed_out_total", "Sources dropped after falling silent"),
+                                ("sourcesTerminated", "sources_terminated_total", "Sources that ended their stream")):
+            metric(name, "counter", help, [("", rx[key])])
+
+    store = snapshot.get("store")
+    if (store is not None):
+        metric("frames_overwritten_total", "counter", "Frames replaced before an output picked them up",
+               [("", store["overwritten"])])
+        metric("frames_lost_total", "counter", "Frames picked up by an output but not sent", [("", store["lost"])])
+
+    outputs = snapshot["outputs"]
+    for key, name, kind, help in (("framesSent", "frames_sent_total", "counter", "Frames sent"),
+                                  ("dropped", "frames_dropped_total", "counter", "Frames dropped as stale"),
+                                  ("suppressed", "frames_unchanged_total", "counter", "Unchanged frames not sent"),
+                                  ("bytesSent", "bytes_sent_total", "counter", "Websocket payload bytes sent"),
+                                  ("messagesSent", "messages_sent_total", "counter", "Websocket messages sent"),
+                                  ("messagesSaved", "messages_saved_total", "counter", "Websocket messages saved by command batching"),
+                                  ("reconnects", "reconnects_total", "counter", "Websocket reconnections"),
+                                  ("fps", "output_fps", "gauge", "Frames sent per second"),
+                                  ("rateLimit", "rate_limit_fps", "gauge", "Adaptive frame rate limit")):
+        metric(name, kind, help, [(_labels(output=o["addr"]), o.get(key)) for o in outputs])
+
+    lines.append("# HELP pbsacn_send_seconds Duration of websocket send calls")
+    lines.append("# TYPE pbsacn_send_seconds histogram")
+    for o in outputs:
+        h = o.get("sendTime")
+        if (h is None):
+            continue
+        for bound, n in h["buckets"]:
+            le = "+Inf" if (bound == float("inf")) else repr(bound)
+            lines.append("pbsacn_send_seconds_bucket%s %d" % (_labels(output=o["addr"], le=le), n))
+        lines.append("pbsacn_send_seconds_sum%s %r" % (_labels(output=o["addr"]), h["sum"]))
+        lines.append("pbsacn_send_seconds_count%s %d" % (_labels(output=o["addr"]), h["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if (path == "/metrics"):
+            body = render_prometheus(self.server.source()).encode("utf-8")
+            ctype = "text/plain; version=0.0.4; charset=utf-8"
+        elif (path == "/metrics.json"):
+            body = json.dumps(self.server.source(), default=str).encode("utf-8")
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Serves the snapshots returned by source() over HTTP on addr:port, from a
+    background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, source, addr = "127.0.0.1", port = 9100):
+        self.source = source
+        super().__init__((addr, port), _MetricsHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="metrics", daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,460 @@
+"""
+ output.py
+
+ A PixelblazeOutput owns the connection to one Pixelblaze and a sender thread
+ that forwards that device's share of each published frame.  Every output has
+ its own scheduler and (optionally) rate controller, so a slow or unresponsive
+ Pixelblaze only holds up its own frames.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from pixelblaze import *
+from frameencoder import FrameEncoder, Rgb565Encoder, ChunkedEncoder
+from scheduler import FrameScheduler
+from ratecontrol import RateController
+from framestore import FrameStore
+from metrics import Histogram
+from transform import TransformChain
+from resample import get_resampler, check_resampling
+import threading
+import time
+
+
+class PixelblazeOutput:
+    """
+    Sends frames to a single Pixelblaze from a dedicated thread.
+    """
+    addr = None
+    pb = None
+    universeMap = None
+    cache = None          # optional DeviceCache
+    revalidate = False    # True if pixelCount came from the cache and should be checked
+    base = 0              # index of this output's first pixel in the shared frame
+    mapPixels = 0         # number of pixels covered by the universe map
+    pixelCount = 0        # number of pixels on the Pixelblaze
+    maxFps = 30
+    targetLatency = None
+    scheduler = None
+    rateControl = None
+    encoder = None
+    transforms = None     # TransformChain applied to each frame before it's encoded
+    resampling = None     # get_resampler() arguments, if the source layout is resampled to fit
+    sendTime = None       # histogram of websocket send durations
+    tracer = None         # optional FrameTracer
+    refreshInterval = 1.0  # seconds between full frame keepalives
+
+    store = None          # FrameStore the frames are read from
+    reader = 0            # this output's reader slot in the store
+    frameTime = 0
+    frameSeq = 0          # number of the frame being sent
+    lastSent = None       # copy of this output's part of the last frame sent, for change detection
+    transformed = None    # buffer for the transformed copy of this output's part of the frame
+    resampled = None      # buffer for the resampled pixels
+    lastResampled = None  # resampled pixels last sent, for chunk change detection
+    lastFull = 0
+    running = False
+    connected = True
+    reconnectDelay = 0.5     # seconds before the first reconnection attempt
+    maxReconnectDelay = 30   # longest wait between attempts
+
+    # statistics
+    framesSent = 0
+    dropped = 0
+    suppressed = 0        # frames not sent because nothing changed
+    chunksSent = 0
+    disconnects = 0
+    fps = 0
+    bytesPerSec = 0
+    show_fps = False
+    notify_ms = 3000
+
+    def __init__(self, addr, universeMap = None, pixelCount = None, cache = None):
+        """
+        Connects to the Pixelblaze at addr and reads its pixel count.  The
+        universeMap gives the layout of this Pixelblaze's pixels, with
+        destination offsets relative to its first pixel.  If pixelCount is
+        given, for example from a DeviceCache, we don't wait for the Pixelblaze's
+        configuration -- the sender thread checks it once it starts.  If a cache
+        is given, it's kept up to date with the configuration.
+        """
+        self.addr = addr
+        self.universeMap = universeMap
+        self.cache = cache
+        self.scheduler = FrameScheduler(self.maxFps)
+        self.encoder = FrameEncoder("pixels")
+        self.transforms = TransformChain()
+        self.sendTime = Histogram()
+        self.pb = Pixelblaze(addr)
+        self.pb.onQueue = self.scheduler.notify    # queued commands go out without waiting for a frame
+        if (pixelCount is None):
+            self.read_config()
+        else:
+            self.pixelCount = pixelCount
+            self.revalidate = True
+        self._thread = None
+        self._resampler = None     # ((mapPixels, pixelCount), Resampler)
+        self._stopped = threading.Event()
+
+    def setMaxOutputFps(self, fps):
+        self.maxFps = fps
+        self.scheduler.setMaxFps(fps)
+
+    def setAdaptiveRate(self, targetLatencyMs = 50):
+        """
+        Enables ack driven rate control for this output.  See ratecontrol.py.
+        Must be called before start().
+        """
+        self.targetLatency = max(1, targetLatencyMs) / 1000
+
+    def setRefreshInterval(self, ms):
+        """
+        Sets how often the full frame is resent, even if nothing has changed.
+        In between, unchanged frames aren't sent at all and, with the chunked
+        listener pattern, only changed chunks are sent.
+        """
+        self.refreshInterval = max(10, ms) / 1000
+
+    def setTransforms(self, transforms):
+        """
+        Sets the color transforms (see transform.py) applied to this output's
+        pixels before they're sent, replacing any set before.  The whole chain
+        is fused into a single pass over the frame.  Takes effect with the
+        next frame.
+        """
+        self.transforms = TransformChain(transforms)
+        self.lastFull = 0         # resend everything with the new transforms
+
+    def setResampling(self, mode = "nearest", grid = None, positions = None):
+        """
+        Resamples this output's pixels to fit the Pixelblaze, rather than
+        truncating them or leaving pixels dark, when its pixel count differs
+        from the universe map's.  mode is "nearest", "linear" or "box".  If the
+        source is a 2D grid, grid gives its (width, height) and positions the
+        (x, y) of each Pixelblaze pixel on it; see resample.py.  None turns
+        resampling off.  Raises ValueError if the settings are invalid.
+        """
+        if (mode is not None):
+            check_resampling(mode, grid, positions)
+        self.resampling = None if (mode is None) else {"mode": mode, "grid": grid, "positions": positions}
+        self._resampler = None
+        self.lastFull = 0
+
+    def resampler(self):
+        """Returns the Resampler for the current pixel counts, or None if we're not resampling"""
+        if (self.resampling is None):
+            return None
+        key = (self.mapPixels, self.pixelCount)
+        if ((self._resampler is None) or (self._resampler[0] != key)):
+            r = self.resampling
+            positions = r["positions"]
+            if (positions is not None):
+                positions = positions[:self.pixelCount]
+            self._resampler = (key, get_resampler(self.mapPixels, self.pixelCount, r["mode"], r["grid"], positions))
+        return self._resampler[1]
+
+    def negotiate_encoding(self):
+        """
+        Chooses the frame encoding supported by the Pixelblaze's active pattern.
+        If it exports pixels0 (see chunked-sacn-listener.js), we send only the
+        chunks that change.  If it exports pixels565 (see rgb565-sacn-listener.js),
+        we send two pixels per value.  Otherwise we fall back to the classic
+        pixels array.
+        """
+        exported = self.pb.getVars() or {}
+        if ("pixels0" in exported):
+            chunkCount = 0
+            while ("pixels%d" % chunkCount in exported):
+                chunkCount += 1
+            self.encoder = ChunkedEncoder(len(exported["pixels0"]), chunkCount)
+        elif (Rgb565Encoder.varName in exported):
+            self.encoder = Rgb565Encoder()
+        else:
+            self.encoder = FrameEncoder("pixels")
+        return self.encoder.varName
+
+    def attach(self, store, reader):
+        """Sets the FrameStore, and this output's reader slot in it, to send frames from"""
+        self.store = store
+        self.reader = reader
+
+    def read_config(self):
+        """Reads the Pixelblaze's pixel count, and updates the cache if we have one"""
+        config = self.pb.getHardwareConfig()
+        self.pixelCount = config['pixelCount']
+        self.revalidate = False
+        if (self.cache is not None):
+            self.cache.update(self.addr, config)
+
+    def start(self):
+        """
+        Starts the output's sender thread.  The thread checks which encoding
+        the active pattern supports (and, if the pixel count came from a cache,
+        rereads it) before it sends anything.
+        """
+        if ((self.resampling is not None) and (self.resampling["grid"] is not None)):
+            width, height = self.resampling["grid"]
+            if (width * height > self.mapPixels):
+                raise ValueError("%dx%d resampling grid is larger than the %d pixels mapped to %s" %
+                                 (width, height, self.mapPixels, self.addr))
+        # build it here, so anything else it objects to is raised to our caller
+        # rather than killing the sender thread
+        self.resampler()
+        if (self.store is None):
+            self.attach(FrameStore(4 * (self.base + self.mapPixels)), 0)
+        if (self.targetLatency is not None):
+            self.rateControl = RateController(self.pb, self.scheduler, self.maxFps, self.targetLatency)
+        self.running = True
+        self._thread = threading.Thread(target=self.run, name="pb-%s" % self.addr, daemon=True)
+        self._thread.start()
+
+    def publish(self):
+        """
+        Called from the receiver thread when a new frame has been published
+        to the store.  Never blocks -- if the sender is still busy with an
+        older frame, it simply picks up the latest one when it's done.
+        """
+        self.scheduler.notify()
+
+    def send_frame(self, frame):
+        """
+        Sends frame if it differs from the last one sent, or if a full refresh
+        is due.  Returns True if anything was sent.
+        """
+        resampler = self.resampler()
+        count = self.mapPixels if (resampler is not None) else min(self.pixelCount, self.mapPixels)
+        a = 4 * self.base
+        b = a + 4 * count
+        view = memoryview(frame)[a:b]
+        now = time.monotonic()
+        full = (now - self.lastFull >= self.refreshInterval)
+        if ((self.lastSent is None) or (len(self.lastSent) != b - a)):
+            self.lastSent = bytearray(b - a)    # first frame, or the pixel count changed
+            full = True
+        if (resampler is not None):
+            size = 4 * resampler.targetCount
+            if ((self.resampled is None) or (len(self.resampled) != size)):
+                self.resampled = bytearray(size)
+                self.lastResampled = bytearray(size)
+                full = True
+        last = memoryview(self.lastSent)
+
+        if ((not full) and (view == last)):
+            self.suppressed += 1
+            return False
+
+        tracer = self.tracer
+        if (tracer is not None):
+            t = tracer.now()
+        # change detection works on the source pixels: resampling and transforms are fixed
+        # between refreshes, so unchanged input means unchanged output
+        src, start = frame, self.base
+        new, old = view, last         # what the chunks are compared on
+        if (resampler is not None):
+            resampler.apply(frame, self.base, self.resampled)
+            src, start, count = self.resampled, 0, resampler.targetCount
+            new, old = memoryview(self.resampled), memoryview(self.lastResampled)
+            if (tracer is not None):
+                tracer.span("resample", t, self.frameSeq)
+                t = tracer.now()
+        if (not self.transforms.identity):
+            if ((self.transformed is None) or (len(self.transformed) != 4 * count)):
+                self.transformed = bytearray(4 * count)
+            self.transforms.apply(src, count, start, self.transformed)
+            src, start = self.transformed, 0
+            if (tracer is not None):
+                tracer.span("transform", t, self.frameSeq)
+                t = tracer.now()
+        if (isinstance(self.encoder, ChunkedEncoder)):
+            step = 4 * self.encoder.chunkSize
+            chunks = range(min(self.encoder.chunkCount, (len(new) + step - 1) // step))
+            if (not full):
+                chunks = [i for i in chunks if (new[i * step:(i + 1) * step] != old[i * step:(i + 1) * step])]
+                if (not chunks):
+                    # the source changed, but not in any way that survived resampling
+                    last[:] = view
+                    self.suppressed += 1
+                    return False
+            data = self.encoder.encode_chunks(src, count, start, chunks)
+            self.chunksSent += len(chunks)
+        else:
+            data = self.encoder.encode(src, count, start)
+
+        if (tracer is not None):
+            tracer.span("encode", t, self.frameSeq)
+        t = time.perf_counter()
+        self.pb.send_bytes(data)
+        end = time.perf_counter()
+        self.sendTime.observe(end - t)
+        if (tracer is not None):
+            tracer.span("send", t, self.frameSeq, end)
+        last[:] = view
+        if (resampler is not None):
+            old[:] = new
+        if (full):
+            self.lastFull = now
+        return True
+
+    def run(self):
+        """
+        Sender thread: forwards frames until stop() is called, reconnecting
+        whenever the connection to the Pixelblaze drops.
+        """
+        timer = time.monotonic()
+        frames = 0
+        sentBytes = self.pb.bytesSent
+
+        try:
+            try:
+                if (self.revalidate):
+                    try:
+                        self.read_config()
+                    except (KeyError, TypeError):
+                        pass     # incomplete answer: carry on with the cached pixel count
+                self.negotiate_encoding()
+            except (websocket.WebSocketException, OSError) as err:
+                self.reconnect(err)
+
+            while (self.running):
+                try:
+                    # wake up for new frames, or when it's time for a keepalive refresh
+                    refresh = None
+                    if (self.lastSent is not None):
+                        refresh = max(0, self.lastFull + self.refreshInterval - time.monotonic())
+                    if (self.tracer is not None):
+                        t = self.tracer.now()
+                    woke = self.scheduler.wait(refresh)
+                    if (not self.running):
+                        break
+                    frame, self.frameSeq, self.frameTime = self.store.acquire(self.reader)
+                    if (frame is None):
+                        continue
+                    if (self.tracer is not None):
+                        self.tracer.span("wait", t, self.frameSeq)
+                    if (not woke):
+                        self.frameTime = time.monotonic()   # resending the latest frame is never stale
+                    if ((self.rateControl is not None) and self.rateControl.stale(self.frameTime)):
+                        self.dropped += 1
+                        self.store.discard(self.reader)
+                        self.pb.flush()    # no frame to carry batched commands
+                        continue
+                    if (not self.send_frame(frame)):
+                        self.pb.flush()
+                        continue
+                    self.scheduler.sent()
+                    self.framesSent += 1
+                    frames += 1
+                    if (self.rateControl is not None):
+                        if (self.tracer is not None):
+                            t = self.tracer.now()
+                            self.rateControl.frame_sent()
+                            self.tracer.span("rate control", t, self.frameSeq)
+                        else:
+                            self.rateControl.frame_sent()
+
+                    # per-device throughput
+                    t = time.monotonic() - timer
+                    if (t * 1000 >= self.notify_ms):
+                        self.fps = frames / t
+                        self.bytesPerSec = (self.pb.bytesSent - sentBytes) / t
+                        if (self.show_fps):
+                            self.print_stats()
+                        timer = time.monotonic()
+                        frames = 0
+                        sentBytes = self.pb.bytesSent
+                except (websocket.WebSocketException, OSError) as err:
+                    if (not self.running):
+                        break
+                    self.reconnect(err)
+
+        except Exception as blarf:
+            template = "Output to {0} halted by unexpected exception. Type: {1},  Args:\n{2!r}"
+            print(template.format(self.addr, type(blarf).__name__, blarf.args))
+            self.running = False
+
+    def reconnect(self, err):
+        """
+        Called from the sender thread when the connection drops.  Retries, with
+        exponential backoff, until the Pixelblaze is back or stop() is called,
+        then re-reads its pixel count and renegotiates the frame encoding, since
+        it may have been reconfigured while it was away.  Meanwhile the receiver
+        keeps publishing, but the frame store only ever holds the latest frame,
+        so nothing queues up: sending resumes with a full refresh of the newest
+        frame.
+        """
+        self.connected = False
+        self.disconnects += 1
+        print("Lost connection to %s (%s), reconnecting" % (self.addr, type(err).__name__))
+        delay = self.reconnectDelay
+        while (self.running):
+            if (self._stopped.wait(delay)):
+                return
+            try:
+                self.pb.close()
+                self.pb.open(self.addr)
+                self.read_config()
+                self.negotiate_encoding()
+                break
+            except (websocket.WebSocketException, OSError, KeyError, TypeError):
+                delay = min(self.maxReconnectDelay, 2 * delay)
+        else:
+            return
+
+        self.connected = True
+        self.lastFull = 0         # refresh at once, with whatever frame is latest
+        if (self.rateControl is not None):
+            self.rateControl.rtt = None
+        print("Reconnected to %s" % self.addr)
+
+    def print_stats(self):
+        line = "%s: %.1f fps, %.1f KB/s, dropped: %d, unchanged: %d" % (self.addr, self.fps, self.bytesPerSec / 1024,
+                                                                      self.dropped, self.suppressed)
+        if (self.rateControl is not None):
+            rc = self.rateControl
+            line += ", rate limit %.1f fps, rtt %s ms" % (rc.fps, "--" if rc.rtt is None else "%.1f" % (rc.rtt * 1000))
+        print(line)
+
+    def stats(self):
+        """Returns a dictionary of this output's throughput statistics"""
+        return {
+            "addr": self.addr,
+            "running": self.running,
+            "connected": self.connected,
+            "disconnects": self.disconnects,
+            "pixelCount": self.pixelCount,
+            "framesSent": self.framesSent,
+            "dropped": self.dropped,
+            "suppressed": self.suppressed,
+            "chunksSent": self.chunksSent,
+            "fps": self.fps,
+            "bytesSent": self.pb.bytesSent,
+            "messagesSent": self.pb.messagesSent,
+            "messagesSaved": self.pb.messagesSaved,
+            "bytesPerSec": self.bytesPerSec,
+            "reconnects": self.pb.reconnects,
+            "rateLimit": None if (self.rateControl is None) else self.rateControl.fps,
+            "sendTime": self.sendTime.snapshot(),
+        }
+
+    def stop(self):
+        self.running = False
+        self._stopped.set()
+        self.scheduler.notify()  # wake the sender so it can exit
+        if (self._thread is not None):
+            self._thread.join(1)
+        self.pb.close()
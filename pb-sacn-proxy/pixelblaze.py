@@ -5,6 +5,18 @@
  controlling a Pixelblaze LED controller.  Requires Python 3 and the websocket-client
  module.
 
+ A background thread reads everything the Pixelblaze sends and hands each
+ response to the request waiting for it, so queries return as soon as their
+ data arrives and sends are never held up by reads.
+
+ Pattern lists, hardware configuration and pattern controls can optionally be
+ cached for a configurable time (see enableCache()), which saves a round trip
+ -- often a slow one -- on each of the many methods that look them up.
+
+ Commands that set state can be batched (see batch() and setBatching()), so
+ that several of them go out as a single websocket message, with repeated
+ writes to the same setting collapsed to the last value.
+
  Copyright 2020 JEM (ZRanger1)
 
  Permission is hereby granted, free of charge, to any person obtaining a copy of this
@@ -30,19 +42,124 @@
 import websocket
 import socket
 import json
+import time
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+
+class _Request:
+    """
+    Utility class: a request waiting for a response from the Pixelblaze.
+    The reader thread offers each incoming message to feed(), which returns
+    True if the message belonged to this request.  The request's future is
+    completed when the whole response has arrived.
+    """
+    binary = False
+
+    def __init__(self, key = None):
+        self.key = key
+        self.future = Future()
+
+    def feed(self, msg):
+        if (self.key in msg):
+            self.future.set_result(msg)
+            return True
+        return False
+
+    def partial(self):
+        """Returns whatever has arrived if the request times out"""
+        return None
+
+
+class _ConfigRequest(_Request):
+    """
+    Utility class: getConfig is answered with several JSON messages.  We're
+    done when both the settings (which carry pixelCount) and the active
+    program have arrived, since they're all any caller reads.  Config
+    messages the firmware sends after those are treated like any other
+    unsolicited message: dropped, or, if another getConfig is already
+    waiting, counted toward it -- harmless, as it's the same configuration.
+    """
+    KEYS = ("pixelCount", "activeProgram", "sequencerMode", "runSequencer")
+
+    def __init__(self):
+        super().__init__()
+        self.config = dict()
+
+    def feed(self, msg):
+        if (not any(k in msg for k in self.KEYS)):
+            return False
+        self.config.update(msg)
+        if (("pixelCount" in self.config) and ("activeProgram" in self.config)):
+            self.future.set_result(self.config)
+        return True
+
+    def partial(self):
+        return self.config
+
+
+class _PatternListRequest(_Request):
+    """
+    Utility class: the pattern list arrives as a series of binary frames of
+    type 0x07, the last of which has bit 2 of its flags byte set.
+    """
+    binary = True
+
+    def __init__(self):
+        super().__init__()
+        self.patterns = dict()
+
+    def feed(self, frame):
+        if (frame[0] != 0x07):
+            return False
+        listFrame = frame[2:].decode("utf-8")
+        listFrame = listFrame.split("\n")
+        listFrame = [m.split("\t") for m in listFrame]
+
+        for pat in listFrame:
+            if (len(pat) == 2):
+                self.patterns[pat[0]] = pat[1]
+
+        if (frame[1] & 0x04):
+            self.future.set_result(self.patterns)
+        return True
+
+    def partial(self):
+        return self.patterns
+
 
 class Pixelblaze:
     ws = None
     connected = False
     flash_save_enabled = False
     default_recv_timeout = 1
+    connect_timeout = 5
     ipAddr = None
+    bytesSent = 0
+    messagesSent = 0
+    reconnects = 0
+    cacheHits = 0
+    cacheMisses = 0
+    batching = False
+    messagesSaved = 0     # messages avoided by batching commands
+    onQueue = None        # called when a command is queued to go out with the next frame
     
     def __init__(self, addr):
         """
         Create and open Pixelblaze object. Takes the Pixelblaze's IPv4 address in the
-        usual 12 digit numeric form (for example, 192.168.1.xxx) 
-        """
+        usual 12 digit numeric form (for example, 192.168.1.xxx).  The websocket
+        port defaults to 81, but may be given as well (for example, 127.0.0.1:8081)
+        """
+        self._pending = []
+        self._lock = threading.Lock()
+        self._reader = None
+        self._cache = dict()
+        self._cacheTtl = None
+        self._batchLock = threading.Lock()
+        self._batch = dict()       # queued commands: top level key -> value
+        self._batchCount = 0       # commands queued since the last flush
+        self._batchDepth = 0       # number of open batch() blocks
         self.open(addr)
 
     def open(self, addr):
@@ -50,22 +167,153 @@ class Pixelblaze:
         Open websocket connection to given ip address.  Called automatically
         when a Pixelblaze object is created - it is not necessary to
         explicitly call open to connect unless the websocket has been closed by the
-        user or by the Pixelblaze.
+        user or by the Pixelblaze.  Gives up after connect_timeout seconds.
         """
         if (self.connected is False):
-            uri = "ws://"+addr+":81"
-            self.ws = websocket.create_connection(uri,sockopt=((socket.SOL_SOCKET, socket.SO_REUSEADDR,1),
-                                                               (socket.IPPROTO_TCP, socket.TCP_NODELAY,1),))
+            uri = "ws://"+addr if (":" in addr) else "ws://"+addr+":81"
+            self.ws = websocket.create_connection(uri,timeout=self.connect_timeout,
+                                                  sockopt=((socket.SOL_SOCKET, socket.SO_REUSEADDR,1),
+                                                           (socket.IPPROTO_TCP, socket.TCP_NODELAY,1),))
             self.ws.settimeout(self.default_recv_timeout)
+            if (self.ipAddr is not None):
+                self.reconnects += 1
             self.ipAddr = addr
             self.connected = True
+            self._reader = threading.Thread(target=self._read_loop, args=(self.ws,),
+                                            name="pb-reader-%s" % addr, daemon=True)
+            self._reader.start()
 
     def close(self):
         """Close websocket connection"""
-        if (self.connected is True):
-            self.ws.close()
+        # the reader thread clears connected if the Pixelblaze drops the
+        # connection, so check the socket too
+        if ((self.connected is True) or ((self.ws is not None) and self.ws.connected)):
             self.connected = False
+            self.ws.close()
+            if (self._reader is not threading.current_thread()):
+                self._reader.join(self.default_recv_timeout)
+
+    def _read_loop(self, ws):
+        """
+        Utility method: reader thread.  Receives every packet from the Pixelblaze
+        and dispatches it to the first pending request that wants it.  Packets
+        nobody asked for (stats, preview frames, etc.) are dropped.
+        """
+        while (self.connected and ws is self.ws):
+            try:
+                msg = ws.recv()
+            except websocket._exceptions.WebSocketTimeoutException:
+                continue   # just lets us notice a close
+            except Exception as err:
+                # connection closed or broken -- fail anything still waiting
+                if (ws is self.ws):
+                    self.connected = False
+                self._fail_pending(websocket._exceptions.WebSocketConnectionClosedException(str(err)))
+                return
+
+            binary = not isinstance(msg, str)
+            if (binary):
+                if (len(msg) < 2):
+                    continue
+            else:
+                try:
+                    msg = json.loads(msg)
+                except ValueError:
+                    continue
+                if (not isinstance(msg, dict)):
+                    continue
+
+            with self._lock:
+                for req in self._pending:
+                    if ((req.binary == binary) and req.feed(msg)):
+                        if (req.future.done()):
+                            self._pending.remove(req)
+                        break
+
+    def _fail_pending(self, err):
+        """Utility method: complete every pending request with an exception"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for req in pending:
+            if (not req.future.done()):
+                req.future.set_exception(err)
+
+    def _request(self, cmd, req, timeout = None):
+        """
+        Utility method: sends cmd and waits up to timeout seconds (default_recv_timeout
+        if not specified) for the response.  Returns the response, or the request's
+        partial result on timeout.
+        """
+        if (self.connected is False):
+            raise websocket._exceptions.WebSocketConnectionClosedException("Pixelblaze is not connected")
+        if (self._batchCount):
+            self.flush()          # anything queued goes first, so the answer reflects it
+        with self._lock:
+            self._pending.append(req)
+        self.send_string(cmd)
+        try:
+            return req.future.result(self.default_recv_timeout if (timeout is None) else timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                if (req in self._pending):
+                    self._pending.remove(req)
+            return req.partial()
             
+    def enableCache(self, patternTtl = 60, configTtl = 5, controlsTtl = 5):
+        """
+        Caches the pattern list, hardware configuration and pattern controls
+        for the given number of seconds.  A TTL of zero disables caching for that
+        item.  The cache is invalidated automatically when this object changes
+        the active pattern, controls or settings; call invalidateCache() if they
+        may have been changed by something else.  Cached results are shared, so
+        don't modify them.
+        """
+        self._cacheTtl = {"patterns": patternTtl, "config": configTtl, "controls": controlsTtl}
+        self._cache.clear()
+
+    def disableCache(self):
+        """Stops caching and discards everything cached"""
+        self._cacheTtl = None
+        self._cache.clear()
+
+    def invalidateCache(self, kind = None):
+        """
+        Discards cached items of the given kind ("patterns", "config" or
+        "controls"), or everything if kind is None.
+        """
+        if (kind is None):
+            self._cache.clear()
+            return
+        for key in list(self._cache):
+            if ((key == kind) or (isinstance(key, tuple) and key[0] == kind)):
+                self._cache.pop(key, None)
+
+    def getCacheStats(self):
+        """Returns a dictionary of cache hit and miss counts"""
+        return {"hits": self.cacheHits, "misses": self.cacheMisses, "entries": len(self._cache)}
+
+    def _cached(self, key, cmd, req, transform = None):
+        """
+        Utility method: returns the cached value for key if caching is enabled
+        and it hasn't expired.  Otherwise sends request cmd, passes the response
+        through transform() if given, and caches the result if the response was
+        complete.
+        """
+        ttl = None if (self._cacheTtl is None) else self._cacheTtl.get(key[0] if isinstance(key, tuple) else key)
+        if (ttl):
+            entry = self._cache.get(key)
+            if ((entry is not None) and (entry[0] > time.monotonic())):
+                self.cacheHits += 1
+                return entry[1]
+            self.cacheMisses += 1
+
+        value = self._request(cmd, req)
+        if ((value is not None) and (transform is not None)):
+            value = transform(value)
+        if (ttl and (value is not None) and req.future.done()):
+            self._cache[key] = (time.monotonic() + ttl, value)
+        return value
+
     def __boolean_to_json_string(self, val):
         """Utility method: Converts Python True/False to JSON true/false"""
         return ',"save":true' if (val is True) else ""
@@ -91,55 +339,152 @@ class Pixelblaze:
         """
         self.flash_save_enabled = True
         
-    def ws_flush(self):
+    def setBatching(self, enabled = True):
+        """
+        Turns on command batching.  Commands that set state -- setVars(),
+        setControls(), setBrightness() and so on -- are then queued rather than
+        sent, with repeated writes to the same variable, control or setting
+        collapsed to the last value.  The queue goes out as one message on the
+        next flush(), or, for a proxy streaming frames, together with the next
+        frame sent with send_bytes().  onQueue, if set, is called whenever a
+        command is queued, so a sender can flush promptly even when it has no
+        frame to send.  Queries flush the queue first, so they always see its
+        effect.
+        """
+        self.batching = enabled
+        if (not enabled):
+            self.flush()
+
+    @contextmanager
+    def batch(self):
         """
-        Utility method: drain websocket receive buffers. Called to clear out unexpected
-        packets before sending requests for data w/send_string(). We do not call it
-        before simply sending commands because it has a small performance cost.
-        
-        This is one of the treacherously "clever" things done to make pyblaze
-        work as a synchronous API when the Pixelblaze may be sending out unexpected
-        packets or talking to multiple devices.  We do some extra work to make sure
-        we're only receiving the packets we want.
+        Context manager that queues the commands issued inside the with block
+        and sends them as one message when it ends:
+
+            with pb.batch():
+                pb.setBrightness(0.5)
+                pb.setControl("speed", 0.2)
+                pb.setControl("speed", 0.3)    # only the last value is sent
         """
-        
-        self.ws.settimeout(0.1)  # set very short timeout
-        
+        with self._batchLock:
+            self._batchDepth += 1
         try:
-            while (True):
-                self.ws.recv()
-        except websocket._exceptions.WebSocketTimeoutException:
-            self.ws.settimeout(self.default_recv_timeout)  # restore normal timeout
-            return   # if we get a timeout, there are no more pending packets
+            yield self
+        finally:
+            with self._batchLock:
+                self._batchDepth -= 1
+                done = (self._batchDepth == 0)
+            if (done):
+                self.flush()
+
+    def _command(self, cmd, merge = ()):
+        """
+        Utility method: sends the dictionary cmd as a message or, when batching,
+        queues its keys.  The values of keys listed in merge are dictionaries,
+        merged into any queued value rather than replacing it.
+        """
+        ahead = None
+        with self._batchLock:
+            if (not (self.batching or self._batchDepth)):
+                queued = False
+            else:
+                if (("activeProgramId" in self._batch) and (("setVars" in cmd) or ("setControls" in cmd))):
+                    # these are for the pattern being switched to, so they have to
+                    # follow the switch rather than share its message
+                    ahead = self._take_batch()
+                for key, value in cmd.items():
+                    if ((key in merge) and (key in self._batch)):
+                        self._batch[key].update(value)
+                    else:
+                        self._batch[key] = dict(value) if (key in merge) else value
+                self._batchCount += 1
+                queued = True
+                tick = not self._batchDepth
+        if (ahead is not None):
+            self._send_batch(*ahead)
+        if (not queued):
+            self.send_string(json.dumps(cmd))
+        elif (tick and (self.onQueue is not None)):
+            self.onQueue()
 
-    def ws_recv(self, wantBinary = False):
+    def _take_batch(self):
+        """Utility method: returns (queued commands, count) and empties the queue.  Lock must be held."""
+        batch, count = self._batch, self._batchCount
+        self._batch = dict()
+        self._batchCount = 0
+        return batch, count
+
+    def flush(self, keys = None):
+        """
+        Sends any queued commands as a single message.  With keys, a list of
+        top level command keys, sends them only if one of those is queued.
+        """
+        if (not self._batchCount):
+            return                # the common case, without taking the lock
+        with self._batchLock:
+            if (not self._batchCount):
+                return
+            if ((keys is not None) and not any((k in self._batch) for k in keys)):
+                return
+            batch, count = self._take_batch()
+        self._send_batch(batch, count)
+
+    def _send_batch(self, batch, count):
         """
-        Utility method: Blocking websocket receive that waits for a packet of a given type
-        and gracefully handles errors and stray extra packets. 
+        Utility method: sends a batch taken from the queue as one message,
+        bypassing send_bytes(), which could add newly queued commands to it.
         """
-        result = None
-        try:
-            while (True):  # loop until we hit timeout or have the packet we want
-                result = self.ws.recv()
-                if ((wantBinary is False) and (type(result) is str)):  # JSON string
-                    break
-                elif ((wantBinary is True) and (result[0] == 0x07)):  # binary pattern list packet
-                    break
-                else:
-                    result = None          # unhandled binary - ignore
-                    
-        except websocket._exceptions.WebSocketTimeoutException:
-            return None                # timeout -- we can just ignore this
-            
-        except websocket._exceptions.WebSocketConnectionClosedException:
-            self.connected = False
-            raise                      
-        
-        return result            
+        if (self.connected is False):
+            raise websocket._exceptions.WebSocketConnectionClosedException("Pixelblaze is not connected")
+        msg = json.dumps(batch).encode("utf-8")
+        self.ws.send(msg)
+        self.bytesSent += len(msg)
+        self.messagesSent += 1
+        self.messagesSaved += count - 1
+
+    def ws_flush(self):
+        """
+        Utility method: formerly drained the websocket receive buffers before
+        a request.  The reader thread now routes every response to the request
+        that asked for it and discards anything else, so there is nothing left
+        to flush.  Retained for compatibility.
+        """
+        return
    
     def send_string(self, cmd):
         """Utility method: Send string-ized JSON to the pixelblaze"""    
-        self.ws.send(cmd.encode("utf-8"))
+        self.send_bytes(cmd.encode("utf-8"))
+
+    def send_bytes(self, data):
+        """
+        Utility method: Send a complete, already encoded JSON message to the
+        Pixelblaze as a text frame.  Raises WebSocketConnectionClosedException
+        if the connection has dropped.
+        """
+        if (self.connected is False):
+            raise websocket._exceptions.WebSocketConnectionClosedException("Pixelblaze is not connected")
+        if (self._batchCount and self.batching and (not self._batchDepth) and data[:1] == b'{'):
+            data = self._piggyback(data)
+        self.ws.send(data)
+        self.bytesSent += len(data)
+        self.messagesSent += 1
+
+    def _piggyback(self, data):
+        """
+        Utility method: returns the JSON object message data with any queued
+        commands added to it.  If the queue sets variables too, it's sent on
+        its own first, since one message can't hold two setVars; likewise if
+        it changes the pattern, so the frame reaches the new one.
+        """
+        with self._batchLock:
+            if (not self._batchCount):
+                return data
+            batch, count = self._take_batch()
+        if (("setVars" in batch) or ("activeProgramId" in batch)):
+            self._send_batch(batch, count)
+            return data
+        self.messagesSaved += count
+        return json.dumps(batch).encode("utf-8")[:-1] + b',' + data[1:]
         
     def waitForEmptyQueue(self,timeout_ms=1000):
         """
@@ -147,27 +492,30 @@ class Pixelblaze:
         timeout_ms milliseconds have elapsed.  Returns True if an empty queue
         acknowldgement was received, False if timeout or error occurs.
         """
-        self.ws_flush()
-        self.ws.settimeout(timeout_ms / 1000)
-        self.send_string('{"ping": true}')
-        result = self.ws.recv()        
-        self.ws.settimeout(self.default_recv_timeout)
+        return self.ping(timeout_ms) is not None
         
-        return True if ((result is not None) and (result.startswith('{"ack"'))) else False                
+    def ping(self, timeout_ms=1000):
+        """
+        Sends a ping and waits for the acknowledgement, which the Pixelblaze
+        sends once it has worked through the messages queued ahead of the ping.
+        Returns the round trip time in seconds, or None if no acknowledgement
+        arrives within timeout_ms milliseconds.
+        """
+        start = time.monotonic()
+        result = self._request('{"ping": true}', _Request("ack"), timeout_ms / 1000)
+        return None if (result is None) else time.monotonic() - start
         
     def getVars(self):
         """Returns JSON object containing all vars exported from the active pattern"""
-        self.ws_flush()  # make sure there are no pending packets    
-        self.send_string('{"getVars": true}')
-        return json.loads(self.ws.recv()).get('vars')
+        result = self._request('{"getVars": true}', _Request("vars"))
+        return None if (result is None) else result.get('vars')
     
     def setVars(self, json_vars):
         """
         Sets pattern variables contained in the json_vars (JSON object) argument.
         Does not check to see if the variables are exported by the current active pattern.
         """
-        jstr = json.dumps(json_vars)
-        self.send_string('{"setVars" : '+jstr+"}")
+        self._command({"setVars": json_vars}, ("setVars",))
         
     def setVariable(self, var_name, value):
         """
@@ -188,20 +536,22 @@ class Pixelblaze:
         
         return True if var_name in val else False
                
-    def _id_from_name(self, patterns, name):
-        """Utility Method: Given the list of patterns and text name of a pattern, returns that pattern's ID"""
-        for key, value in patterns.items(): 
-            if name == value: 
-                return key 
-        return None
-       
+    def _get_patterns(self):
+        """
+        Utility Method: Returns the pattern list and an index of pattern IDs
+        by name, from the cache if possible.
+        """
+        def index(patterns):
+            return (patterns, {name: key for key, name in patterns.items()})
+        return self._cached("patterns", "{ \"listPrograms\" : true }", _PatternListRequest(), index)
+
     # takes either name or id, returns valid id    
     def _get_pattern_id(self, pid):
         """Utility Method: Returns a pattern ID if passed either a valid ID or a text name"""
-        patterns = self.getPatternList()
+        patterns, index = self._get_patterns()
         
         if (patterns.get(pid) is None):
-            pid = self._id_from_name(patterns, pid)
+            pid = index.get(pid)
         
         return pid
     
@@ -215,7 +565,10 @@ class Pixelblaze:
         It does not validate the input id, or determine if the pattern is
         available on the Pixelblaze.
         """
-        self.send_string('{"activeProgramId" : "%s"}'%pid)
+        # queued variables and controls are meant for the pattern that's running now
+        self.flush(("setVars", "setControls"))
+        self._command({"activeProgramId": pid})
+        self.invalidateCache("config")
         
         
     def setActivePattern(self, pid):
@@ -240,36 +593,30 @@ class Pixelblaze:
     def setBrightness(self, n):
         """Set the Pixelblaze's global brightness.  Valid range is 0-1"""
         n = max(0, min(n, 1))  # clamp to proper 0-1 range
-        self.send_string('{"brightness" : %f}'%n)
+        self._command({"brightness": n})
+        self.invalidateCache("config")
                                 
     def setSequenceTimer(self, n):
         """
         Sets number of milliseconds the Pixelblaze's sequencer will run each pattern
         before switching to the next.
         """
-        self.send_string('{"sequenceTimer" : %d}'%n)
+        self._command({"sequenceTimer": int(n)})
+        self.invalidateCache("config")
         
     def startSequencer(self):
         """Enable and start the Pixelblaze's internal sequencer"""
-        self.send_string('{"sequencerEnable": true, "runSequencer" : true }')
+        self._command({"sequencerEnable": True, "runSequencer": True})
+        self.invalidateCache("config")
         
     def stopSequencer(self):
         """Stop and disable the Pixelblaze's internal sequencer"""
-        self.send_string('{"sequencerEnable": false, "runSequencer" : false }')
+        self._command({"sequencerEnable": False, "runSequencer": False})
+        self.invalidateCache("config")
         
     def getHardwareConfig(self):
         """Returns a JSON object containing all the available hardware configuration data"""
-        self.ws_flush()  # make sure there are no pending packets    
-        self.send_string('{"getConfig": true}')
-        hw = dict()
-        
-        p1 = self.ws_recv()
-        while (p1 is not None):
-            p2 = json.loads(p1)
-            hw = {**hw, **p2}
-            p1 = self.ws_recv()                        
-        
-        return hw
+        return self._cached("config", '{"getConfig": true}', _ConfigRequest())
     
     def _get_current_controls(self):
         """
@@ -307,8 +654,9 @@ class Pixelblaze:
             if (pattern is None):
                 return None
         
-            self.send_string('{"getControls": "%s"}'%pattern)
-            ctl = json.loads(self.ws.recv())
+            ctl = self._cached(("controls", pattern), '{"getControls": "%s"}'%pattern, _Request("controls"))
+            if (ctl is None):
+                return None
                 
         # extract controls and their values
         if (len(ctl.get('controls')) > 0):
@@ -326,8 +674,15 @@ class Pixelblaze:
         more information.
         """
         saveStr = self.__get_save_string(saveFlash)
-        jstr = json.dumps(json_ctl)
-        self.send_string('{"setControls": %s %s}'%(jstr,saveStr))
+        if (saveStr):
+            # saving applies to the whole message, so it's never batched
+            self.flush()
+            jstr = json.dumps(json_ctl)
+            self.send_string('{"setControls": %s %s}'%(jstr,saveStr))
+        else:
+            self._command({"setControls": json_ctl}, ("setControls",))
+        self.invalidateCache("config")
+        self.invalidateCache("controls")
         
     def setControl(self, ctl_name, value, saveFlash = False):
         """
@@ -400,30 +755,16 @@ class Pixelblaze:
         the saveFlash parameter to make your new timing (semi) permanent.
         """
         saveStr = self.__get_save_string(saveFlash)
-        self.send_string('{"dataSpeed" : %d %s}'%(speed,saveStr))       
+        if (saveStr):
+            self.flush()
+            self.send_string('{"dataSpeed" : %d %s}'%(speed,saveStr))
+        else:
+            self._command({"dataSpeed": int(speed)})
+        self.invalidateCache("config")       
     
     def getPatternList(self):
         """
         Returns a dictionary containing the unique ID and the text name of all
         saved patterns on the Pixelblaze
         """
-        patterns = dict()
-        self.ws_flush()  # make sure there are no pending packets    
-        self.send_string("{ \"listPrograms\" : true }")
-        
-        frame = self.ws_recv(True)
-        while (frame is not None):
-            listFrame = frame[2:].decode("utf-8")
-            listFrame = listFrame.split("\n")
-            listFrame = [m.split("\t") for m in listFrame]
-               
-            for pat in listFrame:
-                if (len(pat) == 2):
-                    patterns[pat[0]] = pat[1]
-               
-            if (frame[1] & 0x04):
-                break
-            frame = self.ws_recv(True)
-
-        return patterns
-                      
+        return dict(self._get_patterns()[0])
@@ -0,0 +1,235 @@
+"""
+ pixelpack.py
+
+ Batched conversion of DMX channel data into the packed RGB values used by
+ the RGB SACN Listener pattern.  A whole universe is converted in one pass
+ into a preallocated buffer, using NumPy if it is installed and the standard
+ library's bytearray/memoryview machinery if it is not.
+
+ Run this file directly for a micro-benchmark of both packing paths.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import sys
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HAVE_NUMPY = numpy is not None
+
+# Each pixel is stored as a native-endian signed 32-bit integer holding the
+# 24-bit RGB value, sign extended from bit 23.  Divided by 256, that's exactly
+# the 16.16 fixed point number the listener pattern unpacks: values with red
+# 128 and up wrap to negative.  The legacy loop tested for > 32767 instead,
+# so it also wrapped red 127, green 255, blue 1 and up to about -32768 -- a
+# value the pattern can't represent.  Those pixels now pack to 32767.x, which
+# is intended.  These are the byte offsets of each component within a pixel's
+# 4 byte word.
+if (sys.byteorder == "little"):
+    R_OFS, G_OFS, B_OFS, SIGN_OFS = 2, 1, 0, 3
+else:
+    R_OFS, G_OFS, B_OFS, SIGN_OFS = 1, 2, 3, 0
+
+# translation table for sign extension: red >= 128 means a negative value
+_SIGN_TABLE = bytes(0 if (i < 128) else 255 for i in range(256))
+
+# saturating lookup for adding white into the RGB channels
+_SATURATE = bytes(min(i, 255) for i in range(511))
+
+# bound method used to scale packed values to Pixelblaze numbers without a
+# Python level loop
+_SCALE = (1 / 256).__mul__
+
+
+class PixelPacker:
+    """
+    Converts DMX RGB channel data into packed Pixelblaze pixel values.
+    All storage is allocated once, when the packer is created.
+    """
+    maxPixels = 0
+    useNumpy = False
+    words = None    # raw storage, 4 bytes per pixel
+    pixels = None   # signed 32-bit view of words (numpy array or memoryview)
+
+    def __init__(self, maxPixels, useNumpy = None):
+        """
+        Create a packer with room for maxPixels pixels.  By default, NumPy is used
+        if it is available.  Pass useNumpy = False to force the pure Python path.
+        """
+        self.maxPixels = max(1, maxPixels)
+        self.useNumpy = HAVE_NUMPY if (useNumpy is None) else (useNumpy and HAVE_NUMPY)
+        self.words = bytearray(4 * self.maxPixels)
+
+        if (self.useNumpy):
+            self._bytes = numpy.frombuffer(self.words, dtype=numpy.uint8).reshape(self.maxPixels, 4)
+            self._signLut = numpy.frombuffer(_SIGN_TABLE, dtype=numpy.uint8)
+            self.pixels = numpy.frombuffer(self.words, dtype=numpy.int32)
+        else:
+            self.pixels = memoryview(self.words).cast('i')
+
+    def pack(self, dmxData, startPixel, count, startChannel = 0):
+        """
+        Packs up to count pixels from dmxData, beginning at DMX channel offset
+        startChannel, into the buffer starting at startPixel.  dmxData may be a
+        tuple (as delivered by the sacn module), bytes, bytearray or memoryview.
+        Returns the number of pixels actually packed.
+        """
+        n = min(count, (len(dmxData) - startChannel) // 3, self.maxPixels - startPixel)
+        if (n <= 0):
+            return 0
+        end = startChannel + 3 * n
+
+        if (self.useNumpy):
+            if (isinstance(dmxData, tuple)):
+                # bytes() converts a tuple of ints much faster than numpy.array()
+                src = numpy.frombuffer(bytes(dmxData[startChannel:end]), dtype=numpy.uint8)
+            else:
+                src = numpy.frombuffer(dmxData, dtype=numpy.uint8, count=3 * n, offset=startChannel)
+            src = src.reshape(n, 3)
+            dest = self._bytes[startPixel:startPixel + n]
+            dest[:, R_OFS] = src[:, 0]
+            dest[:, G_OFS] = src[:, 1]
+            dest[:, B_OFS] = src[:, 2]
+            dest[:, SIGN_OFS] = self._signLut[src[:, 0]]
+        else:
+            src = bytes(dmxData[startChannel:end])
+            self._scatter(startPixel, n, src[0::3], src[1::3], src[2::3])
+
+        return n
+
+    def pack_segment(self, dmxData, seg):
+        """
+        Packs the pixels described by a compiled universe map segment (see
+        universemap.py) from dmxData, honoring the segment's color order.
+        RGBW data is folded into RGB by adding white to each channel.
+        Returns the number of pixels actually packed.
+        """
+        stride = seg.stride
+        n = min(seg.pixelCount, (len(dmxData) - seg.first) // stride, self.maxPixels - seg.destOffset)
+        if (n <= 0):
+            return 0
+        if (isinstance(dmxData, tuple)):
+            src = bytes(dmxData[seg.first:seg.first + stride * n])
+        else:
+            # a view, so the receive buffer is read in place rather than copied
+            src = memoryview(dmxData)[seg.first:seg.first + stride * n]
+
+        if (self.useNumpy):
+            chans = numpy.frombuffer(src, dtype=numpy.uint8)[seg.index[:n]]
+            if (seg.hasWhite):
+                chans = numpy.minimum(chans[:, :3] + chans[:, 3:].astype(numpy.uint16), 255)
+            dest = self._bytes[seg.destOffset:seg.destOffset + n]
+            dest[:, R_OFS] = chans[:, 0]
+            dest[:, G_OFS] = chans[:, 1]
+            dest[:, B_OFS] = chans[:, 2]
+            dest[:, SIGN_OFS] = self._signLut[chans[:, 0]]
+        else:
+            sl = seg.slices
+            r, g, b = src[sl[0]], src[sl[1]], src[sl[2]]
+            if (seg.hasWhite):
+                w = src[sl[3]]
+                r, g, b = (bytes(map(_SATURATE.__getitem__, map(operator.add, c, w))) for c in (r, g, b))
+            self._scatter(seg.destOffset, n, r, g, b)
+
+        return n
+
+    def _scatter(self, startPixel, n, red, green, blue):
+        """Utility method: interleaves n bytes of each color channel into the pixel words"""
+        base = 4 * startPixel
+        stop = base + 4 * n
+        w = self.words
+        w[base + R_OFS:stop:4] = red
+        w[base + G_OFS:stop:4] = green
+        w[base + B_OFS:stop:4] = blue
+        if (not isinstance(red, bytes)):
+            red = w[base + R_OFS:stop:4]      # a memoryview slice has no translate()
+        w[base + SIGN_OFS:stop:4] = red.translate(_SIGN_TABLE)
+
+    def values(self, count, start = 0):
+        """
+        Returns a list of count packed pixel values, starting at pixel start,
+        scaled to the numbers expected by the listener pattern's pixels array.
+        """
+        return unpack(self.words, count, start, self.useNumpy)
+
+
+def unpack(words, count, start = 0, useNumpy = HAVE_NUMPY):
+    """
+    Returns a list of count Pixelblaze pixel values, starting at pixel start,
+    from a buffer of packed pixel words -- either a packer's own buffer or a
+    snapshot of one.
+    """
+    end = min(start + count, len(words) // 4)
+    if (useNumpy and HAVE_NUMPY):
+        return (numpy.frombuffer(words, dtype=numpy.int32)[start:end] * (1 / 256)).tolist()
+    return list(map(_SCALE, memoryview(words).cast('i')[start:end]))
+
+
+def _legacy_pack(pixels, dmxPixels, startPixel, pixelsPerUniverse):
+    """The original per-pixel packing loop, kept here for benchmark comparison"""
+    index = 0
+    pixNum = startPixel
+    max = startPixel + pixelsPerUniverse
+    while(pixNum < max):
+        pixels[pixNum] = ((dmxPixels[index] << 16) | (dmxPixels[index + 1] << 8) | dmxPixels[index + 2]) / 256.0
+        if (pixels[pixNum] > 32767) :
+            pixels[pixNum] = pixels[pixNum] - 65536
+        pixNum += 1
+        index += 3
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    universes = 4
+    pixelsPerUniverse = 170
+    frames = 2000
+    data = [tuple(random.randrange(256) for i in range(512)) for u in range(universes)]
+
+    def bench(name, packFn):
+        t = time.perf_counter()
+        for f in range(frames):
+            for u in range(universes):
+                packFn(data[u], u * pixelsPerUniverse)
+        t = time.perf_counter() - t
+        print("%-14s %12.0f pixels/sec" % (name, frames * universes * pixelsPerUniverse / t))
+
+    def matches_legacy(values):
+        # the legacy loop wrongly wraps values just above 32767 (see above)
+        return all((v == l) or ((v > 32767) and (v - 65536 == l)) for v, l in zip(values, legacy))
+
+    legacy = [0 for x in range(universes * pixelsPerUniverse)]
+    bench("legacy loop", lambda d, start: _legacy_pack(legacy, d, start, pixelsPerUniverse))
+
+    packer = PixelPacker(universes * pixelsPerUniverse, useNumpy=False)
+    bench("memoryview", lambda d, start: packer.pack(d, start, pixelsPerUniverse))
+    if (not matches_legacy(packer.values(len(legacy)))):
+        print("memoryview packer output does not match legacy loop!")
+
+    if (HAVE_NUMPY):
+        packer = PixelPacker(universes * pixelsPerUniverse, useNumpy=True)
+        bench("numpy", lambda d, start: packer.pack(d, start, pixelsPerUniverse))
+        if (not matches_legacy(packer.values(len(legacy)))):
+            print("numpy packer output does not match legacy loop!")
+    else:
+        print("numpy          not installed")
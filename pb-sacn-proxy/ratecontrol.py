@@ -0,0 +1,96 @@
+"""
+ ratecontrol.py
+
+ Congestion control for the proxy's output to a Pixelblaze.  At regular
+ intervals we ping the Pixelblaze and time its acknowledgement.  Since the ack
+ is only sent after every message queued ahead of it has been processed, the
+ round trip time measures how long a frame sits in the Pixelblaze's websocket
+ queue.  The send rate is raised additively while that stays under the latency
+ target, and cut multiplicatively when it doesn't, so the queue never gets the
+ chance to back up.  Frames that are older than the latency limit by the time
+ the sender gets to them are dropped rather than sent late.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import time
+
+
+class RateController:
+    """
+    Adjusts a FrameScheduler's maximum frame rate to keep the Pixelblaze's
+    queueing delay under targetLatency seconds.
+    """
+    fps = 30
+    minFps = 5
+    maxFps = 60
+    targetLatency = 0.05    # seconds of queueing delay we're willing to accept
+    maxLatency = 0.2        # frames older than this are dropped
+    probeInterval = 0.5     # seconds between pings
+    increase = 1            # additive increase, in fps
+    decrease = 0.7          # multiplicative decrease
+    rtt = None              # smoothed round trip time, seconds
+    dropped = 0
+    probes = 0
+    lostAcks = 0
+
+    def __init__(self, pb, scheduler, maxFps = 60, targetLatency = 0.05, maxLatency = None):
+        self.pb = pb
+        self.scheduler = scheduler
+        self.maxFps = maxFps
+        self.fps = min(self.fps, maxFps)
+        self.targetLatency = targetLatency
+        self.maxLatency = max(4 * targetLatency, 0.1) if (maxLatency is None) else maxLatency
+        self._nextProbe = time.monotonic() + self.probeInterval
+        self.scheduler.setMaxFps(self.fps)
+
+    def stale(self, frameTime):
+        """
+        Returns True (and counts a dropped frame) if a frame published at
+        frameTime (time.monotonic()) is too old to be worth sending.
+        """
+        if (time.monotonic() - frameTime > self.maxLatency):
+            self.dropped += 1
+            return True
+        return False
+
+    def frame_sent(self):
+        """
+        Called by the sender after each frame.  Periodically probes the
+        Pixelblaze's queue and adjusts the send rate.
+        """
+        now = time.monotonic()
+        if (now < self._nextProbe):
+            return
+
+        rtt = self.pb.ping(int(1000 * self.maxLatency * 2))
+        self.probes += 1
+        self._nextProbe = time.monotonic() + self.probeInterval
+
+        if (rtt is None):
+            # no ack in time -- the queue is badly backed up, or the ack was lost
+            self.lostAcks += 1
+            self.fps = max(self.minFps, self.fps * self.decrease * self.decrease)
+        else:
+            self.rtt = rtt if (self.rtt is None) else (0.75 * self.rtt + 0.25 * rtt)
+            if (self.rtt > self.targetLatency):
+                self.fps = max(self.minFps, self.fps * self.decrease)
+            else:
+                self.fps = min(self.maxFps, self.fps + self.increase)
+
+        self.scheduler.setMaxFps(self.fps)
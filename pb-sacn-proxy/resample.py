@@ -0,0 +1,282 @@
+"""
+ resample.py
+
+ Spatial resampling between the pixel layout of the incoming sACN content
+ and the Pixelblaze's own pixels, for when content authored at one
+ resolution drives a strip of another.
+
+ A Resampler precomputes, for every target pixel, the source pixels it
+ takes color from and their weights -- a sparse table of at most a few taps
+ per pixel.  Each frame is then a single gather through that table, plus a
+ weighted sum for the filtering modes:
+
+   nearest   each target pixel copies the closest source pixel
+   linear    linear interpolation between the two closest source pixels
+             (bilinear, between four, for 2D sources)
+   box       the average of the source pixels the target pixel covers,
+             for smooth downsampling
+
+ The source is either a line of pixels or a 2D grid, stored row by row.  A
+ grid is mapped onto the target through a list of (x, y) positions, one per
+ target pixel in wiring order, with 0-1 spanning the grid; matrix_positions()
+ builds the list for common matrix wiring.  Tables are cached by source
+ size, target size and mapping, so outputs that share a layout share one,
+ and a Pixelblaze that comes back with a new pixel count only costs a
+ lookup.
+
+ Run this file directly for a quick benchmark.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from pixelpack import numpy, HAVE_NUMPY, R_OFS, G_OFS, B_OFS, SIGN_OFS, _SIGN_TABLE
+from itertools import repeat
+import functools
+import operator
+import array
+import math
+
+RESAMPLE_NEAREST = "nearest"
+RESAMPLE_LINEAR = "linear"
+RESAMPLE_BOX = "box"
+
+_WEIGHT_ONE = 256          # weights are fixed point, summing to this for every target pixel
+
+
+def matrix_positions(width, height, serpentine = False, columns = False):
+    """
+    Returns the (x, y) position of each pixel of a width x height matrix, in
+    wiring order: row by row, or column by column if columns is True, with
+    every other row (or column) reversed if serpentine is True.
+    """
+    positions = []
+    outer, inner = (width, height) if (columns) else (height, width)
+    for i in range(outer):
+        for j in range(inner):
+            if (serpentine and (i & 1)):
+                j = inner - 1 - j
+            c, r = (i, j) if (columns) else (j, i)
+            positions.append(((c + 0.5) / width, (r + 0.5) / height))
+    return positions
+
+
+def _box_1d(center, size, limit):
+    """Utility function: (index, weight) of the cells covered by [center - size/2, center + size/2)"""
+    lo = max(0.0, center - size / 2)
+    hi = min(float(limit), center + size / 2)
+    taps = []
+    for i in range(int(math.floor(lo)), int(math.ceil(hi))):
+        overlap = min(hi, i + 1) - max(lo, i)
+        if (overlap > 1e-9):
+            taps.append((i, overlap))
+    return taps or [(min(limit - 1, max(0, int(center))), 1.0)]
+
+
+def _linear_1d(p, limit):
+    """Utility function: (index, weight) of the two cells either side of pixel coordinate p"""
+    p = max(0.0, min(limit - 1.0, p))
+    i = min(int(p), limit - 1)
+    frac = p - i
+    if ((frac < 1e-9) or (i + 1 >= limit)):
+        return [(i, 1.0)]
+    return [(i, 1.0 - frac), (i + 1, frac)]
+
+
+def check_resampling(mode, grid = None, positions = None):
+    """Raises ValueError if Resampler would reject these settings"""
+    if (mode not in (RESAMPLE_NEAREST, RESAMPLE_LINEAR, RESAMPLE_BOX)):
+        raise ValueError("Unsupported resampling mode: %s" % mode)
+    if (grid is not None):
+        if (positions is None):
+            raise ValueError("Resampling a 2D grid needs the position of every target pixel")
+        width, height = grid
+        if ((width < 1) or (height < 1)):
+            raise ValueError("Unsupported resampling grid: %dx%d" % (width, height))
+
+
+class Resampler:
+    """
+    Maps sourceCount packed pixels onto targetCount.  grid gives the source's
+    (width, height) when it's a 2D grid, in which case positions -- one (x, y)
+    per target pixel -- say where each target pixel sits on it.  Build these
+    with get_resampler(), which caches them.
+    """
+    useNumpy = HAVE_NUMPY
+
+    def __init__(self, sourceCount, targetCount, mode = RESAMPLE_NEAREST, grid = None, positions = None,
+                 useNumpy = None):
+        check_resampling(mode, grid, positions)
+        if (useNumpy is not None):
+            self.useNumpy = bool(useNumpy) and HAVE_NUMPY
+        if (grid is not None):
+            width, height = grid
+            sourceCount = width * height
+            targetCount = len(positions)
+        self.sourceCount = max(1, sourceCount)
+        self.targetCount = max(1, targetCount)
+        self.mode = mode
+
+        if (grid is None):
+            table = [self._taps_1d(i) for i in range(self.targetCount)]
+        else:
+            table = [self._taps_2d(x, y, width, height) for x, y in positions]
+        self._compile(table)
+
+    def _taps_1d(self, i):
+        """Utility method: the (source index, weight) taps for target pixel i of a line"""
+        scale = self.sourceCount / self.targetCount
+        if (self.mode == RESAMPLE_NEAREST):
+            return [(min(self.sourceCount - 1, int((i + 0.5) * scale)), 1.0)]
+        if (self.mode == RESAMPLE_LINEAR):
+            return _linear_1d((i + 0.5) * scale - 0.5, self.sourceCount)
+        return _box_1d((i + 0.5) * scale, max(1.0, scale), self.sourceCount)
+
+    def _taps_2d(self, x, y, width, height):
+        """Utility method: the (source index, weight) taps for a target pixel at (x, y) on a grid"""
+        x = min(1.0, max(0.0, x)) * width
+        y = min(1.0, max(0.0, y)) * height
+        if (self.mode == RESAMPLE_NEAREST):
+            return [(min(height - 1, int(y)) * width + min(width - 1, int(x)), 1.0)]
+        if (self.mode == RESAMPLE_LINEAR):
+            xs = _linear_1d(x - 0.5, width)
+            ys = _linear_1d(y - 0.5, height)
+        else:
+            # each target pixel covers its share of the grid's area
+            size = max(1.0, math.sqrt(width * height / self.targetCount))
+            xs = _box_1d(x, size, width)
+            ys = _box_1d(y, size, height)
+        return [(r * width + c, wr * wc) for r, wr in ys for c, wc in xs]
+
+    def _compile(self, table):
+        """
+        Utility method: quantizes the weights and lays the table out as taps
+        rows of targetCount indices and weights, padding with zero weights.
+        """
+        taps = max(len(t) for t in table)
+        self.taps = taps
+        self.indices = [[0] * self.targetCount for k in range(taps)]
+        self.weights = [[0] * self.targetCount for k in range(taps)]
+        for i, entry in enumerate(table):
+            total = sum(w for s, w in entry)
+            q = [int(round(_WEIGHT_ONE * w / total)) for s, w in entry]
+            q[q.index(max(q))] += _WEIGHT_ONE - sum(q)    # make the weights sum exactly to one
+            for k, ((s, w), wq) in enumerate(zip(entry, q)):
+                self.indices[k][i] = s
+                self.weights[k][i] = wq
+        self.direct = (taps == 1)
+        self._gathers = [operator.itemgetter(*idx) if (len(idx) > 1) else (lambda seq, i=idx[0]: (seq[i],))
+                         for idx in self.indices]
+        if (self.useNumpy):
+            self._idx = numpy.array(self.indices, dtype=numpy.intp)
+            self._w = numpy.array(self.weights, dtype=numpy.uint32)[:, :, None]
+            self._signLut = numpy.frombuffer(_SIGN_TABLE, dtype=numpy.uint8)
+
+    def apply(self, words, start, dest):
+        """
+        Resamples the sourceCount packed pixels of words beginning at pixel
+        start into the first targetCount pixels of the bytearray dest.
+        """
+        a = 4 * start
+        b = a + 4 * self.sourceCount
+        t = self.targetCount
+        if (self.useNumpy):
+            if (self.direct):
+                src = numpy.frombuffer(words, dtype=numpy.int32, count=self.sourceCount, offset=a)
+                numpy.frombuffer(dest, dtype=numpy.int32, count=t)[:] = src[self._idx[0]]
+                return
+            src = numpy.frombuffer(words, dtype=numpy.uint8, count=b - a, offset=a).reshape(-1, 4)
+            out = numpy.frombuffer(dest, dtype=numpy.uint8, count=4 * t).reshape(t, 4)
+            acc = (src[self._idx] * self._w).sum(axis=0)        # one gather: taps x targetCount x 4
+            out[:] = (acc + _WEIGHT_ONE // 2) >> 8
+            out[:, SIGN_OFS] = self._signLut[out[:, R_OFS]]
+            return
+
+        if (self.direct):
+            memoryview(dest).cast('i')[:t] = array.array('i', self._gathers[0](memoryview(words)[a:b].cast('i')))
+            return
+        src = bytes(memoryview(words)[a:b])
+        for ofs in (R_OFS, G_OFS, B_OFS):
+            chan = src[ofs::4]
+            acc = repeat(_WEIGHT_ONE // 2)
+            for gather, weights in zip(self._gathers, self.weights):
+                acc = map(operator.add, acc, map(operator.mul, gather(chan), weights))
+            dest[ofs:4 * t:4] = bytes(map(operator.rshift, acc, repeat(8)))
+        dest[SIGN_OFS:4 * t:4] = dest[R_OFS:4 * t:4].translate(_SIGN_TABLE)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_resampler(sourceCount, targetCount, mode, grid, positions):
+    return Resampler(sourceCount, targetCount, mode, grid, positions)
+
+
+def get_resampler(sourceCount, targetCount, mode = RESAMPLE_NEAREST, grid = None, positions = None):
+    """
+    Returns a Resampler for the given sizes and mapping, building its table
+    only the first time a combination is asked for.
+    """
+    if (positions is not None):
+        positions = tuple((float(x), float(y)) for x, y in positions)
+    if (grid is not None):
+        grid = (int(grid[0]), int(grid[1]))
+    return _cached_resampler(sourceCount, targetCount, mode, grid, positions)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+    from pixelpack import PixelPacker
+
+    sourceCount = 680
+    frames = 500
+    packer = PixelPacker(sourceCount)
+    for u in range(4):
+        packer.pack(tuple(random.randrange(256) for i in range(510)), u * 170, 170)
+    words = bytes(packer.words)
+
+    def per_pixel(r, words, dest):
+        # the same table, one pixel and one tap at a time
+        for i in range(r.targetCount):
+            rgb = [0, 0, 0]
+            for k in range(r.taps):
+                s, w = r.indices[k][i], r.weights[k][i]
+                for c, ofs in enumerate((R_OFS, G_OFS, B_OFS)):
+                    rgb[c] += words[4 * s + ofs] * w
+            for c, ofs in enumerate((R_OFS, G_OFS, B_OFS)):
+                dest[4 * i + ofs] = (rgb[c] + 128) >> 8
+            dest[4 * i + SIGN_OFS] = _SIGN_TABLE[dest[4 * i + R_OFS]]
+
+    cases = [("nearest 680->300", dict(sourceCount=680, targetCount=300, mode=RESAMPLE_NEAREST)),
+             ("linear 680->1000", dict(sourceCount=680, targetCount=1000, mode=RESAMPLE_LINEAR)),
+             ("box 680->300", dict(sourceCount=680, targetCount=300, mode=RESAMPLE_BOX)),
+             ("box 34x20->16x16", dict(sourceCount=0, targetCount=0, mode=RESAMPLE_BOX, grid=(34, 20),
+                                       positions=matrix_positions(16, 16, serpentine=True)))]
+    for name, kw in cases:
+        paths = [("python", False)] + ([("numpy", True)] if (HAVE_NUMPY) else [])
+        ref = None
+        for path, useNumpy in paths:
+            r = Resampler(useNumpy=useNumpy, **kw)
+            dest = bytearray(4 * r.targetCount)
+            t = time.perf_counter()
+            for f in range(frames):
+                r.apply(words, 0, dest)
+            t = time.perf_counter() - t
+            if (ref is None):
+                ref = bytearray(len(dest))
+                per_pixel(r, words, ref)
+            print("%-18s %-7s %2d taps %10.0f frames/sec%s" % (name, path, r.taps, frames / t,
+                                                              "" if (dest == ref) else "  MISMATCH"))
@@ -29,67 +29,262 @@
  v0.0.2   12/01/2020   JEM(ZRanger1)    Changed lib to pixelblaze-client
 """
 
-from pixelblaze import *
-import sacn
+from pixelpack import PixelPacker
+from universemap import UniverseMap
+from assembler import FrameAssembler
+from output import PixelblazeOutput
+from framestore import FrameStore
+from workerpool import WorkerPool
+from metrics import MetricsServer
+from tracer import FrameTracer
+from discovery import discover, address_key, DeviceCache
+from merge import SourceMerger
+from capture import CaptureWriter, CaptureReplayer
+from resample import check_resampling
+from concurrent.futures import ThreadPoolExecutor
+from e131receiver import E131Receiver
 import time
 import sys
-import array
+
+try:
+    import sacn
+except ImportError:
+    sacn = None
 
 class sacnProxy:
     """
-    Listens for e1.31 (sACN) data and forwards it to a Pixelblaze.
+    Listens for e1.31 (sACN) data and forwards it to one or more Pixelblazes.
     """
-    pb = None
     receiver = None
+    outputs = None
     pixelsPerUniverse = 170
-    pixelCount = 0
-    dataReady = False
+    maxUniverses = 4
     notifyTimer = 0
-    FrameCount = 0
-    delay = 0.033333  # default to 30 fps outgoing limit
+    cpuTimer = 0
+    startTime = 0
+    incomingFps = 0
+    lastFrames = 0
+    metricsServer = None
+    metricsAddr = None
+    tracer = None
+    traceFile = None
     notify_ms = 3000  # throughput check every <notify_ms> milliseconds
     show_fps = False
     
-    pixels = []
+    segments = None
+    assembler = None
+    frameDeadline = None
+    packer = None
+    pixels = None
+    store = None
+    workers = 0
+    pool = None
+    maxFps = 30
+    targetLatency = None
+    transforms = ()
+    commandBatching = False
+    universeMap = None    # map for the first output, if set before it was added
+    refreshInterval = None     # ms, if set for every output
+    resampling = None          # (mode, grid, positions), if set for every output
+    merger = None
+    capture = None        # CaptureWriter recording incoming packets
+    replayer = None       # CaptureReplayer feeding us a recorded show
     
-    def __init__(self, bindAddr, pixelBlazeAddr):       
-        self.pixels = [0 for x in range(512)]  # max size of a dmx universe tuple
-
-        self.pb = Pixelblaze(pixelBlazeAddr)   # create Pixelblaze object        
-        result = self.pb.getHardwareConfig()   
-        self.pixelCount = result['pixelCount']    
+    nativeReceiver = False
+    
+    def __init__(self, bindAddr, pixelBlazeAddr = None, nativeReceiver = False):       
+        """
+        Creates a proxy listening on bindAddr.  If pixelBlazeAddr is given, it
+        is added as the first output.  More Pixelblazes can be added with
+        addOutput().  If nativeReceiver is True, or the sacn module isn't
+        installed, the proxy uses its own lightweight E1.31 receiver (see
+        e131receiver.py) rather than the sacn module's.
+        """
+        self.outputs = []
+        if (pixelBlazeAddr is not None):
+            self.addOutput(pixelBlazeAddr)
 
         # bind multicast receiver to specific IP address
-        self.receiver = sacn.sACNreceiver(bind_address=bindAddr)     
+        self.nativeReceiver = nativeReceiver or (sacn is None)
+        if (self.nativeReceiver):
+            self.receiver = E131Receiver(bindAddr)
+        else:
+            self.receiver = sacn.sACNreceiver(bind_address=bindAddr)     
+
+    def addOutput(self, pixelBlazeAddr, universeMap = None):
+        """
+        Connects to a Pixelblaze and adds it to the proxy's outputs. The
+        universeMap gives the universes feeding this Pixelblaze, with
+        destination offsets relative to its first pixel.  If universeMap is
+        None, the Pixelblaze gets the classic layout of pixelsPerUniverse
+        pixels per universe, in maxUniverses consecutive universes starting
+        after those used by the previously added outputs.
+        Returns the new PixelblazeOutput object.
+        """
+        return self._add_output(PixelblazeOutput(pixelBlazeAddr, universeMap))
+
+    def addOutputs(self, addrs, cacheFile = None):
+        """
+        Connects to several Pixelblazes at once and adds them to the outputs,
+        in address order, with the default universe layout.  If cacheFile is
+        given, Pixelblazes seen on an earlier run start with their cached pixel
+        counts rather than waiting for their configuration, which is checked
+        in the background once they start.  Pixelblazes that can't be reached
+        are skipped.  Returns the list of new PixelblazeOutput objects.
+        """
+        cache = None if (cacheFile is None) else DeviceCache(cacheFile)
+        addrs = sorted(set(addrs), key=address_key)
+
+        def connect(addr):
+            try:
+                return PixelblazeOutput(addr, None, None if (cache is None) else cache.pixelCount(addr), cache)
+            except Exception as blarf:
+                template = "Unable to connect to Pixelblaze at {0}. Type: {1},  Args:\n{2!r}"
+                print(template.format(addr, type(blarf).__name__, blarf.args))
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(addrs))) as connector:
+            outputs = list(connector.map(connect, addrs))
+        return [self._add_output(out) for out in outputs if (out is not None)]
+
+    def discoverOutputs(self, seconds = 2.0, expected = None, cacheFile = None):
+        """
+        Listens for Pixelblaze beacons for up to <seconds> seconds, or until
+        <expected> Pixelblazes have been heard, then adds every Pixelblaze found
+        as an output.  See addOutputs() for cacheFile.  Returns the list of new
+        PixelblazeOutput objects.
+        """
+        found = discover(seconds, expected)
+        print("Found %d Pixelblaze%s %s" % (len(found), "" if (len(found) == 1) else "s",
+                                           " ".join(sorted(found, key=address_key))))
+        return self.addOutputs(found.keys(), cacheFile)
+
+    def _add_output(self, out):
+        """Utility method: applies the proxy's settings to a new output and adds it"""
+        if ((not self.outputs) and (out.universeMap is None)):
+            out.universeMap = self.universeMap
+        out.setMaxOutputFps(self.maxFps)
+        if (self.targetLatency is not None):
+            out.setAdaptiveRate(self.targetLatency * 1000)
+        if (self.transforms):
+            out.setTransforms(self.transforms)
+        if (self.commandBatching):
+            out.pb.setBatching(True)
+        if (self.refreshInterval is not None):
+            out.setRefreshInterval(self.refreshInterval)
+        if (self.resampling is not None):
+            out.setResampling(*self.resampling)
+        self.outputs.append(out)
+        return out
+
+    def start_listening(self):
+        """
+        Compiles the outputs' universe maps into a single lookup table over a
+        shared pixel buffer, then registers a listener for each universe.
+        Note that although the e1.31 protocol provides reliable transport,
+        due to throughput constraints, some frames may be dropped and will
+        not be sent to the Pixelblaze.  The goal is that the overall
+        visualization be reasonably smooth, accurate and timely.
+        """
+        self.segments = dict()
+        base = 0
+        nextUniverse = 1
+        for out in self.outputs:
+            if (out.universeMap is None):
+                out.universeMap = UniverseMap.default(self.maxUniverses, self.pixelsPerUniverse, nextUniverse)
+            nextUniverse = max(out.universeMap.universes(), default=0) + 1
+            out.base = base
+            out.mapPixels = out.universeMap.pixelCount()
+            out.universeMap.compile(base, self.segments)
+            base += out.mapPixels
+
+        self.packer = PixelPacker(max(1, base))
+        self.pixels = self.packer.pixels
+        if (self.workers > 0):
+            self.pool = WorkerPool(len(self.packer.words), self.workers)
+            self.pool.notify_ms = self.notify_ms
+        else:
+            self.store = FrameStore(len(self.packer.words), len(self.outputs))
+            for i, out in enumerate(self.outputs):
+                out.attach(self.store, i)
+        self.assembler = FrameAssembler(self.segments.keys(), self.publish_frame, self.frameDeadline)
+
+        # a single bound method serves every universe -- the packet tells us which
+        # universe it belongs to, and the compiled map does the rest.
+        if (self.nativeReceiver):
+            self.receiver.tracer = self.tracer
+            if (self.merger is not None):
+                self.receiver.filterPriority = False
+            if (self.capture is not None):
+                self.receiver.listen(self.segments.keys(), self.on_capture_data, self.on_capture_sync)
+            else:
+                self.receiver.listen(self.segments.keys(), self.receive_callback(), self.assembler.sync)
+        else:
+            for universe in self.segments:
+                self.receiver.listen_on('universe', universe=universe)(self.on_packet)
         self.receiver.start()  # start receiver thread
 
-        # define callback functions for the universes we're interested in
-        # for this test, we arbitrarily allow 170 pixels per universe, and
-        # listen to universes 1-4 for a total of 680 possible pixels.
-        # Note that although the e1.31 protocol provides reliable transport,
-        # due to throughput constraints, some frames may be dropped and will
-        # not be sent to the Pixelblaze.  The goal is that the overall
-        # visualization be reasonably smooth, accurate and timely.
-       
-        @self.receiver.listen_on('universe', universe=1) 
-        def callback_one(packet):  # packet is type sacn.DataPacket.
-            self.pack_data(packet.dmxData, 0)
-            self.dataReady = True
-
-        @self.receiver.listen_on('universe', universe=2) 
-        def callback_two(packet):  
-            self.pack_data(packet.dmxData, self.pixelsPerUniverse)
-            self.dataReady = True        
-            
-        @self.receiver.listen_on('universe', universe=3) 
-        def callback_three(packet):  
-            self.pack_data(packet.dmxData, self.pixelsPerUniverse * 2)
-            self.dataReady = True        
-            
-        @self.receiver.listen_on('universe', universe=4) 
-        def callback_four(packet):  
-            self.pack_data(packet.dmxData, self.pixelsPerUniverse * 3)
-            self.dataReady = True
+    def on_packet(self, packet):  # packet is type sacn.DataPacket.
+        # the sacn module never delivers sync packets, so a frame waiting on
+        # its sync address would only ever be published on deadline.  Treat
+        # every packet as unsynchronized.
+        if (self.capture is not None):
+            self.capture.write(packet.universe, bytes(packet.dmxData), packet.sequence, packet.priority,
+                               0, bytes(packet.cid))
+        self.assembler.receive(packet.universe, packet.sequence, 0, self.pack_data, packet.dmxData)
+
+    def on_data(self, universe, data, sequence, priority, syncAddr, cid, options):
+        """
+        Native receiver callback.  data is only valid until we return.  The
+        receiver has already checked the sequence per source, so the assembler
+        mustn't check it again per universe: that would discard a new source's
+        packets after a failover until its sequence passed the old source's.
+        """
+        self.assembler.receive(universe, None, syncAddr, self.pack_data, data)
+
+    def receive_callback(self):
+        """Returns the callback that takes packets in the native receiver's onData format"""
+        return self.on_data if (self.merger is None) else self.on_merge_data
+
+    def on_capture_data(self, universe, data, sequence, priority, syncAddr, cid, options):
+        """Native receiver callback when recording: records the packet, then processes it"""
+        self.capture.write(universe, data, sequence, priority, syncAddr, cid, options)
+        self.receive_callback()(universe, data, sequence, priority, syncAddr, cid, options)
+
+    def on_capture_sync(self, syncAddr):
+        self.capture.write_sync(syncAddr)
+        self.assembler.sync(syncAddr)
+
+    def on_merge_data(self, universe, data, sequence, priority, syncAddr, cid, options):
+        """
+        Native receiver callback when merging sources.  The receiver has already
+        checked the sequence for this source, so the assembler needn't.
+        """
+        levels, lead = self.merger.receive(universe, cid, data, priority, options)
+        if (levels is None):
+            return
+        if (lead):
+            self.assembler.receive(universe, None, syncAddr, self.pack_data, levels)
+        else:
+            self.assembler.update(universe, self.pack_data, levels)
+
+    def publish_frame(self):
+        """
+        Called by the frame assembler when a frame is complete. Copies the
+        packed pixels into the frame store, so the receiver can't tear the
+        frame while it's sent, and wakes every output.
+        """
+        if (self.tracer is not None):
+            t = self.tracer.now()
+        if (self.pool is not None):
+            self.pool.publish(self.packer.words)
+        else:
+            self.store.publish(self.packer.words)
+            for out in self.outputs:
+                out.publish()
+        if (self.tracer is not None):
+            self.tracer.span("publish", t, self.assembler.frames)
+            self.tracer.inputFrame = self.assembler.frames + 1
             
     def debugPrintFps(self):
         self.show_fps = True
@@ -97,71 +292,324 @@ class sacnProxy:
     def setPixelsPerUniverse(self, pix):
         self.pixelsPerUniverse =  max(1, min(pix, 170))  # clamp to 1-170 pixels
         
+    def setUniverseMap(self, universeMap):
+        """
+        Sets the UniverseMap describing which universes and channels feed which
+        pixels on the first output.  If no output has been added yet, the map
+        goes to the first one added.  Must be called before run().
+        """
+        if (self.outputs):
+            self.outputs[0].universeMap = universeMap
+        else:
+            self.universeMap = universeMap
+        
+    def setFrameDeadline(self, ms):
+        """
+        Sets the number of milliseconds to wait for all universes of a frame
+        to arrive before sending it anyway.  Must be called before run().
+        """
+        self.frameDeadline = max(1, ms) / 1000
+
     def setMaxOutputFps(self, fps):
-        self.delay = 1 / fps
+        """Sets the maximum frame rate for every output"""
+        self.maxFps = fps
+        for out in self.outputs:
+            out.setMaxOutputFps(fps)
+
+    def setAdaptiveRate(self, targetLatencyMs = 50):
+        """
+        Enables congestion control on every output.  Rather than sending at a
+        fixed rate, each output measures its Pixelblaze's queueing delay with
+        periodic pings and adjusts its frame rate, up to the maximum set by
+        setMaxOutputFps(), to keep the delay under targetLatencyMs.  Frames that
+        can't be sent in time are dropped.  Must be called before run().
+        """
+        self.targetLatency = max(1, targetLatencyMs) / 1000
+        for out in self.outputs:
+            out.setAdaptiveRate(targetLatencyMs)
         
+    def setRefreshInterval(self, ms):
+        """
+        Sets how often every output, including outputs added later, resends
+        its full frame as a keepalive.  Between refreshes, unchanged frames are
+        not sent.
+        """
+        self.refreshInterval = ms
+        for out in self.outputs:
+            out.setRefreshInterval(ms)
+
+    def setTransforms(self, transforms, addr = None):
+        """
+        Sets the color transforms applied to each output's pixels before they're
+        sent -- for example [Gamma(2.2), Brightness(0.5), ColorOrder("GRB")].
+        See transform.py.  With addr, only the output for that Pixelblaze is
+        changed; otherwise every output, including outputs added later.
+        """
+        if (addr is None):
+            self.transforms = tuple(transforms)
+        for out in self.outputs:
+            if ((addr is None) or (out.addr == addr)):
+                out.setTransforms(transforms)
+
+    def setCommandBatching(self, enabled = True):
+        """
+        Queues the commands sent to each output's Pixelblaze -- setControls(),
+        setBrightness() and so on -- and sends them along with the next frame,
+        rather than as messages of their own.  Repeated writes to the same
+        setting between frames collapse to the last value.  See setBatching()
+        in pixelblaze.py.
+        """
+        self.commandBatching = enabled
+        for out in self.outputs:
+            out.pb.setBatching(enabled)
+
+    def setMergeMode(self, mode = "htp", maxSources = 8):
+        """
+        Merges universes sent by more than one source -- for example two
+        consoles, or a main and a backup show controller.  Sources are told
+        apart by CID; only the highest priority sources count, and when
+        several share it, their levels are merged per channel, "htp" (highest
+        level wins) or "ltp" (latest change wins).  See merge.py.  Without
+        merging, the highest priority source wins.  Needs the built-in
+        receiver, since the sacn module filters out all but one source
+        before we see the packets.  Must be called before run().
+        """
+        if (not self.nativeReceiver):
+            raise ValueError("Source merging needs the built-in receiver: create the proxy with nativeReceiver=True")
+        self.merger = SourceMerger(mode, maxSources)
+
+    def setResampling(self, mode = "nearest", grid = None, positions = None, addr = None):
+        """
+        Resamples the pixels each output receives to fit its Pixelblaze's pixel
+        count, so content authored at a different resolution isn't cut off or
+        left short.  mode is "nearest", "linear" or "box".  For content laid out
+        as a 2D grid, give its (width, height) as grid and the (x, y) position
+        of each Pixelblaze pixel on it, from 0 to 1, as positions -- see
+        matrix_positions() in resample.py.  With addr, only that Pixelblaze's
+        output is changed; otherwise every output, including outputs added
+        later.  None turns resampling off.
+        """
+        if (mode is not None):
+            check_resampling(mode, grid, positions)
+        if (addr is None):
+            self.resampling = None if (mode is None) else (mode, grid, positions)
+        for out in self.outputs:
+            if ((addr is None) or (out.addr == addr)):
+                out.setResampling(mode, grid, positions)
+
+    def setCapture(self, filename, delta = True):
+        """
+        Records every packet received on our universes to filename, appending
+        if it exists, for replaying later with setReplay().  With delta True,
+        packets are stored as the channels that changed since the source's last
+        packet, which keeps captures of slowly changing shows small.  See
+        capture.py.  Must be called before run().
+        """
+        self.capture = CaptureWriter(filename, delta)
+
+    def setReplay(self, filename, speed = 1.0, loop = False):
+        """
+        Plays a capture recorded with setCapture() into the proxy once run()
+        starts, alongside anything arriving from the network.  speed scales
+        the recorded timing; 0 replays as fast as the proxy can keep up, to
+        measure its throughput.  Unless loop is True, run() returns when the
+        replay ends.  Must be called before run().
+        """
+        self.replayer = CaptureReplayer(self, filename, speed, loop)
+
+    def setWorkerProcesses(self, workers):
+        """
+        Runs the outputs in <workers> worker processes rather than threads of
+        this process, so that large installations can use more than one core.
+        Frames are passed to the workers through shared memory.  Zero, the
+        default, keeps everything in one process.  Must be called before run().
+        """
+        self.workers = max(0, workers)
+
+    def setMetricsPort(self, port = 9100, addr = "127.0.0.1"):
+        """
+        Serves runtime metrics over HTTP on addr:port -- in Prometheus text format
+        at /metrics, and as JSON at /metrics.json.  Must be called before run().
+        """
+        self.metricsAddr = (addr, port)
+
+    def setTracing(self, capacity = 8192, filename = None):
+        """
+        Enables per-frame tracing.  Every pipeline stage records a timed span,
+        tagged with its frame number, in a ring buffer holding the most recent
+        <capacity> spans.  If filename is given, the trace is written to it, in
+        Chrome trace event format, when the proxy stops.  See also dumpTrace().
+        In worker process mode, only the receiver process is traced.
+        Must be called before run().
+        """
+        self.tracer = FrameTracer(capacity)
+        self.traceFile = filename
+
+    def dumpTrace(self, filename):
+        """Writes the spans traced so far to filename in Chrome trace event format"""
+        if (self.tracer is not None):
+            self.tracer.dump(filename)
+
     def setThroughputCheckInterval(self, ms):
         self.notify_ms = max(500,ms)  # min interval is 1/2 second, default should be about 3 sec
     
-    def time_millis(self):
-        return int(round(time.time() * 1000))
-    
     def calc_frame_stats(self):
-        self.FrameCount += 1
-        
-        t = self.time_millis() - self.notifyTimer
-        if (t >= self.notify_ms):
-            t = 1000 * self.FrameCount / self.notify_ms
+        """
+        Updates the incoming frame rate every notify_ms milliseconds, and prints
+        a summary if debugPrintFps() was called.
+        """
+        now = time.monotonic()
+        t = now - self.notifyTimer
+        if (t * 1000 >= self.notify_ms):
+            a = self.assembler
+            self.incomingFps = (a.frames - self.lastFrames) / t
+            self.lastFrames = a.frames
             if (self.show_fps):
-                print("Incoming fps: %d"%t)
-            self.FrameCount = 0                                      
-          
-            self.notifyTimer = self.time_millis()                  
-        pass
+                print("Incoming: %.1f fps, %d packets (incomplete: %d, late: %d, out of order: %d), cpu %.0f%%"
+                      %(self.incomingFps, sum(a.packets.values()), a.incomplete, a.late, a.outOfOrder,
+                        100 * (time.process_time() - self.cpuTimer) / t))
+                if (self.pool is not None):
+                    self.pool.print_stats()
+                else:
+                    print("Frames overwritten before sending: %d, lost: %d" % (self.store.overwritten, self.store.lost))
+            self.cpuTimer = time.process_time()
+            self.notifyTimer = now
+
+    def getMetrics(self):
+        """
+        Returns a snapshot of the proxy's runtime metrics: packets received per
+        universe, frame assembly and source merge counters under "receiver",
+        frame store counters under "store" (None in worker process mode), and
+        the outputs' statistics, including send duration histograms, under
+        "outputs".
+        """
+        a = self.assembler
+        rx = {"packets": {}, "framesAssembled": 0, "incomplete": 0, "late": 0, "outOfOrder": 0,
+              "fps": self.incomingFps}
+        if (a is not None):
+            with a.lock:
+                rx.update(packets=dict(a.packets), framesAssembled=a.frames, incomplete=a.incomplete,
+                          late=a.late, outOfOrder=a.outOfOrder)
+        if (self.nativeReceiver):
+            rx["invalid"] = self.receiver.invalid
+            rx["outOfOrder"] += self.receiver.outOfOrder
+        if (self.merger is not None):
+            m = self.merger
+            rx.update(sources=m.sourceCount(), merges=m.merges, lowPriority=m.lowPriority,
+                      sourcesTimedOut=m.timedOut, sourcesTerminated=m.terminated)
+        store = None
+        if (self.store is not None):
+            store = {"published": self.store.published, "overwritten": self.store.overwritten, "lost": self.store.lost}
+        return {
+            "uptime": time.monotonic() - self.startTime if (self.startTime) else 0,
+            "receiver": rx,
+            "store": store,
+            "outputs": self.getStats(),
+        }
+
+    def getStats(self):
+        """Returns a list of per-output throughput statistics dictionaries"""
+        if (self.pool is not None):
+            return self.pool.stats()
+        return [out.stats() for out in self.outputs]
     
-    def pack_data(self, dmxPixels,startPixel):
-        index = 0
-        pixNum = startPixel
-        max = startPixel + self.pixelsPerUniverse
-        while(pixNum < max):
-            self.pixels[pixNum] = ((dmxPixels[index] << 16) | (dmxPixels[index + 1] << 8) | dmxPixels[index + 2]) / 256.0
-            if (self.pixels[pixNum] > 32767) :
-                self.pixels[pixNum] = self.pixels[pixNum] - 65536
-            pixNum += 1
-            index += 3             
-
-    def send_frame(self, pb):
-        self.pb.setVariable("pixels", self.pixels[0:self.pixelCount])
-        
+    def pack_data(self, dmxPixels, universe):
+        if (self.tracer is not None):
+            t = self.tracer.now()
+        for seg in self.segments.get(universe, ()):
+            self.packer.pack_segment(dmxPixels, seg)
+        if (self.tracer is not None):
+            self.tracer.span("pack %d" % universe, t)
+
     def run(self):
                     
-        # start listening for multicasts -- joining a single universe seems to get you 
-        # multicast packets for all universes, at least from lightshowpi.
-        # TODO - verify that this works with other sacn providers
-        self.receiver.join_multicast(1)
-        self.notifyTimer = self.time_millis() 
+        self.start_listening()
+
+        for out in self.outputs:
+            out.show_fps = self.show_fps
+            out.notify_ms = self.notify_ms
+            out.tracer = self.tracer
+        if (self.pool is not None):
+            self.pool.start(self.outputs)
+        else:
+            for out in self.outputs:
+                out.start()
+
+        # start listening for multicasts.  Joining a single universe seems to get you
+        # packets for all universes from lightshowpi, but other sACN providers
+        # need us to join each universe's group.
+        for universe in self.segments:
+            self.receiver.join_multicast(universe)
+        self.startTime = self.notifyTimer = time.monotonic()
+        self.cpuTimer = time.process_time()
+        if (self.metricsAddr is not None):
+            self.metricsServer = MetricsServer(self.getMetrics, *self.metricsAddr)
+            self.metricsServer.start()
+        if (self.replayer is not None):
+            self.replayer.start()
         
-        # loop forever, listening for sacn packets and forwarding the pixel data
-        # to Pixelblaze
+        # Each output sends from its own thread.  All that's left for us is to
+        # publish frames whose deadline expires before they're complete.  We
+        # only wake up when there's a frame pending, or to update statistics.
         while True:    
-            time.sleep(self.delay) # limit outgoing framerate
-            
-            if (self.dataReady == True):
-                self.send_frame(self.pb)               
-                self.calc_frame_stats()                                      
-                self.dataReady = False
+            self.assembler.pendingEvent.wait(self.notify_ms / 1000)
+            t = self.assembler.timeout()
+            if (self.tracer is not None):
+                start = self.tracer.now()
+            if (t):
+                time.sleep(t)
+            if (self.assembler.expire() and (self.tracer is not None)):
+                self.tracer.span("deadline", start, self.assembler.frames)
+            self.calc_frame_stats()
+            if ((self.replayer is not None) and self.replayer.done.is_set()):
+                t = self.assembler.timeout()
+                if (t):
+                    time.sleep(t)
+                self.assembler.expire()    # publish whatever's left of the last frame
+                r = self.replayer
+                print("Replayed %d packets in %.2f s, %d frames assembled" % (r.packets, r.seconds, self.assembler.frames))
+                return
                 
     def stop(self):
+        if (self.replayer is not None):
+            self.replayer.stop()
         self.receiver.stop()
-        self.pb.close()
+        if (self.capture is not None):
+            self.capture.close()
+        if (self.metricsServer is not None):
+            self.metricsServer.stop()
+        if (self.traceFile is not None):
+            self.dumpTrace(self.traceFile)
+        if (self.pool is not None):
+            self.pool.stop()
+        for out in self.outputs:
+            out.stop()
         
     
 
 if __name__ == "__main__":
 
     mirror = sacnProxy("192.168.1.20","192.168.1.15")  # arguments: ip address of proxy machine, ip address of pixelblaze
+    # to drive more Pixelblazes from the same proxy, add them here. By default, each
+    # takes the next block of universes.
+    # mirror.addOutput("192.168.1.16")
+    # or, to find every Pixelblaze on the network, caching their pixel counts so the
+    # next startup needn't wait for them:
+    # mirror.discoverOutputs(3, cacheFile="pixelblazes.json")
     mirror.setPixelsPerUniverse(170)
+    if (len(sys.argv) > 1):
+        mirror.setUniverseMap(UniverseMap.load(sys.argv[1]))  # optional JSON universe map file
     mirror.setMaxOutputFps(30)
+    # to merge several sources of the same universes (needs nativeReceiver=True):
+    # mirror.setMergeMode("htp")
+    # to record the incoming show, or to play back a recording instead of listening:
+    # mirror.setCapture("show.cap")
+    # mirror.setReplay("show.cap", speed=1.0)
+    # to fit content of a different resolution to each Pixelblaze's pixel count:
+    # mirror.setResampling("linear")
+    # optional color correction, e.g.:
+    # from transform import Gamma, Brightness
+    # mirror.setTransforms([Gamma(2.2), Brightness(0.6)])
     mirror.setThroughputCheckInterval(3000)
     mirror.debugPrintFps()
     
@@ -169,14 +617,16 @@ if __name__ == "__main__":
         mirror.run()   # run forever (until stopped by ctrl-c or exception)
        
     except KeyboardInterrupt:
-        mirror.stop()
         print("sacnProxy halted by keyboard interrupt")
     
     except Exception as blarf:
-        mirror.stop()
         template = "sacnProxy halted by unexpected exception. Type: {0},  Args:\n{1!r}"
         message = template.format(type(blarf).__name__, blarf.args)
         print(message)         
+
+    finally:
+        # run() also returns normally, once a one-off replay is done
+        mirror.stop()
         
         
 
@@ -0,0 +1,70 @@
+"""
+ scheduler.py
+
+ Event driven output scheduling for the proxy's sender.  The receiver calls
+ notify() when new pixel data lands; the sender blocks in wait() until then,
+ so a completed frame goes out immediately (subject to a minimum interval
+ between frames) and an idle show costs no wakeups at all.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import threading
+import time
+
+
+class FrameScheduler:
+    """
+    Wakes the sender when a frame is ready, no more often than maxFps times
+    per second.
+    """
+    minInterval = 0.033333  # default to 30 fps outgoing limit
+    lastSend = 0
+
+    def __init__(self, maxFps = 30):
+        self._ready = threading.Event()
+        self.setMaxFps(maxFps)
+
+    def setMaxFps(self, fps):
+        """Sets the maximum rate at which wait() will release the sender"""
+        self.minInterval = 1 / max(0.1, fps)
+
+    def notify(self):
+        """Called by the receiver when new data is available.  Safe from any thread."""
+        self._ready.set()
+
+    def wait(self, timeout = None):
+        """
+        Blocks until new data has arrived and at least minInterval seconds have
+        passed since the previous call to sent().  Returns True if a frame is
+        ready to send, False if timeout (in seconds) expired first.
+        """
+        if (not self._ready.wait(timeout)):
+            return False
+
+        # pace output.  Data arriving while we sleep is picked up by this frame,
+        # so we clear the flag afterwards rather than before.
+        holdoff = self.lastSend + self.minInterval - time.monotonic()
+        if (holdoff > 0):
+            time.sleep(holdoff)
+        self._ready.clear()
+        return True
+
+    def sent(self):
+        """Called by the sender after each frame goes out"""
+        self.lastSend = time.monotonic()
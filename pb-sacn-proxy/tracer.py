@@ -0,0 +1,93 @@
+"""
+ tracer.py
+
+ Optional per-frame tracing.  When enabled, each pipeline stage -- packet
+ receive and packing, frame publishing, the sender's wait, encoding, the
+ websocket send and the rate controller's ping -- records a timed span
+ tagged with the number of the frame it worked on.  Spans are kept in a
+ bounded ring buffer and can be written out in Chrome trace event format,
+ for viewing in chrome://tracing or https://ui.perfetto.dev.
+
+ When tracing is off, each stage costs one attribute test.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import itertools
+import threading
+import json
+import time
+import os
+
+
+class FrameTracer:
+    """
+    Bounded ring buffer of timed spans.  span() may be called from any thread.
+    Frame numbers match the frame assembler's count: spans recorded while a
+    frame is being received are tagged with inputFrame, the number of the
+    frame being assembled.
+    """
+    capacity = 8192
+    inputFrame = 1
+    now = staticmethod(time.perf_counter)
+
+    def __init__(self, capacity = 8192):
+        self.capacity = max(16, capacity)
+        self.clear()
+
+    def clear(self):
+        self._events = [None] * self.capacity
+        self._counter = itertools.count()
+        self._threads = dict()     # thread id -> name, remembered in case the thread exits before a dump
+
+    def span(self, name, start, frame = None, end = None):
+        """
+        Records a span named name from start (a now() timestamp) until end,
+        or until now if end is None, for the given frame number.
+        """
+        if (end is None):
+            end = time.perf_counter()
+        if (frame is None):
+            frame = self.inputFrame
+        tid = threading.get_ident()
+        if (tid not in self._threads):
+            self._threads[tid] = threading.current_thread().name
+        # next() on an itertools.count is atomic, so concurrent writers each get their own slot
+        self._events[next(self._counter) % self.capacity] = (name, start, end, frame, tid)
+
+    def events(self):
+        """Returns the recorded spans, oldest first, as (name, start, end, frame, threadId) tuples"""
+        return sorted((e for e in self._events if (e is not None)), key=lambda e: e[1])
+
+    def chrome_trace(self):
+        """Returns the recorded spans as a Chrome trace event format dictionary"""
+        events = self.events()
+        pid = os.getpid()
+        names = self._threads
+        base = events[0][1] if (events) else 0
+        trace = [{"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": names.get(tid, str(tid))}}
+                 for tid in set(e[4] for e in events)]
+        for name, start, end, frame, tid in events:
+            trace.append({"ph": "X", "name": name, "cat": "frame", "pid": pid, "tid": tid,
+                          "ts": (start - base) * 1e6, "dur": (end - start) * 1e6, "args": {"frame": frame}})
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def dump(self, filename):
+        """Writes the recorded spans to filename in Chrome trace event JSON format"""
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,187 @@
+"""
+ transform.py
+
+ Per-output color transforms, applied to each frame between the frame store
+ and the encoder: gamma correction, brightness and color balance, and color
+ order swaps.
+
+ Every built-in transform is either a 256-entry lookup table per channel or
+ a reordering of the channels, so a whole chain of them compiles down to one
+ table per output channel, plus the source channel each one reads.  Applying
+ the chain is then a single pass over the frame -- a bytes.translate() per
+ channel, or a NumPy table lookup -- however many transforms it contains.
+
+ Run this file directly for a quick benchmark.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from pixelpack import numpy, HAVE_NUMPY, R_OFS, G_OFS, B_OFS, SIGN_OFS, _SIGN_TABLE
+
+_IDENTITY = bytes(range(256))
+_CHANNEL_OFS = (R_OFS, G_OFS, B_OFS)
+
+
+def _table(fn):
+    """Utility function: builds a lookup table from a function of 0-255 to 0-255"""
+    return bytes(max(0, min(255, int(round(fn(i))))) for i in range(256))
+
+
+class Transform:
+    """
+    Base class.  compose() takes the chain so far, as a list giving, for each
+    output channel (red, green, blue), a (sourceChannel, table) tuple, and
+    returns the chain with this transform appended.
+    """
+
+    def compose(self, channels):
+        return channels
+
+
+class LutTransform(Transform):
+    """A transform that maps each channel through its own lookup table"""
+    tables = (_IDENTITY, _IDENTITY, _IDENTITY)
+
+    def compose(self, channels):
+        return [(src, table.translate(lut)) for (src, table), lut in zip(channels, self.tables)]
+
+
+class Gamma(LutTransform):
+    """Gamma correction.  A single gamma, or a separate one for red, green and blue."""
+
+    def __init__(self, gamma = 2.2):
+        gammas = gamma if isinstance(gamma, (tuple, list)) else (gamma,) * 3
+        self.tables = tuple(_table(lambda i, g=g: 255 * (i / 255) ** g) for g in gammas)
+
+
+class Brightness(LutTransform):
+    """Scales every channel by level, 0-1"""
+
+    def __init__(self, level = 1.0):
+        level = max(0.0, min(1.0, level))
+        self.tables = (_table(lambda i: i * level),) * 3
+
+
+class ColorBalance(LutTransform):
+    """Scales red, green and blue separately, each 0-1"""
+
+    def __init__(self, red = 1.0, green = 1.0, blue = 1.0):
+        self.tables = tuple(_table(lambda i, k=max(0.0, min(1.0, k)): i * k) for k in (red, green, blue))
+
+
+class ColorOrder(Transform):
+    """
+    Reorders the channels: ColorOrder("GRB") sends green in the red position,
+    red in the green position and blue unchanged.
+    """
+
+    def __init__(self, order = "RGB"):
+        order = order.upper()
+        if (sorted(order) != ["B", "G", "R"]):
+            raise ValueError("Unsupported color order: %s" % order)
+        self.order = tuple("RGB".index(c) for c in order)
+
+    def compose(self, channels):
+        return [channels[i] for i in self.order]
+
+
+class TransformChain:
+    """
+    A compiled chain of transforms.  apply() writes the transformed copy of
+    a range of packed pixels (see pixelpack.py) into a separate buffer.
+    """
+    useNumpy = False      # bytes.translate() benchmarks faster than NumPy's gathers here
+    identity = True
+
+    def __init__(self, transforms = (), useNumpy = None):
+        if (useNumpy is not None):
+            self.useNumpy = bool(useNumpy) and HAVE_NUMPY
+        channels = [(0, _IDENTITY), (1, _IDENTITY), (2, _IDENTITY)]
+        for t in transforms:
+            channels = t.compose(channels)
+        self.transforms = tuple(transforms)
+        self.sources = tuple(_CHANNEL_OFS[src] for src, table in channels)
+        self.tables = tuple(table for src, table in channels)
+        self.identity = (channels == [(0, _IDENTITY), (1, _IDENTITY), (2, _IDENTITY)])
+        if (self.useNumpy):
+            self._luts = tuple(numpy.frombuffer(t, dtype=numpy.uint8) for t in self.tables)
+            self._signLut = numpy.frombuffer(_SIGN_TABLE, dtype=numpy.uint8)
+
+    def apply(self, words, count, start, dest):
+        """
+        Transforms count pixels of words, beginning at pixel start, into the
+        first count pixels of the bytearray dest.
+        """
+        a = 4 * start
+        b = a + 4 * count
+        if (self.useNumpy):
+            src = numpy.frombuffer(words, dtype=numpy.uint8, count=b - a, offset=a).reshape(count, 4)
+            out = numpy.frombuffer(dest, dtype=numpy.uint8, count=b - a).reshape(count, 4)
+            for ofs, srcOfs, lut in zip(_CHANNEL_OFS, self.sources, self._luts):
+                out[:, ofs] = lut[src[:, srcOfs]]
+            out[:, SIGN_OFS] = self._signLut[out[:, R_OFS]]
+        else:
+            src = bytes(memoryview(words)[a:b])
+            n = b - a
+            for ofs, srcOfs, table in zip(_CHANNEL_OFS, self.sources, self.tables):
+                dest[ofs:n:4] = src[srcOfs::4].translate(table)
+            dest[SIGN_OFS:n:4] = dest[R_OFS:n:4].translate(_SIGN_TABLE)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+    from pixelpack import PixelPacker
+
+    pixelCount = 680
+    frames = 2000
+    packer = PixelPacker(pixelCount)
+    for u in range(4):
+        packer.pack(tuple(random.randrange(256) for i in range(512)), u * 170, 170)
+    words = bytes(packer.words)
+    chain = [Gamma(2.2), Brightness(0.5), ColorBalance(1.0, 0.9, 0.8), ColorOrder("GRB")]
+
+    def per_pixel(words, dest):
+        # the same chain, one pixel and one transform at a time
+        for i in range(pixelCount):
+            r, g, b = words[4 * i + R_OFS], words[4 * i + G_OFS], words[4 * i + B_OFS]
+            r, g, b = (round(255 * (c / 255) ** 2.2) for c in (r, g, b))
+            r, g, b = (round(c * 0.5) for c in (r, g, b))
+            r, g, b = round(r * 1.0), round(g * 0.9), round(b * 0.8)
+            r, g = g, r
+            dest[4 * i + R_OFS], dest[4 * i + G_OFS], dest[4 * i + B_OFS] = r, g, b
+            dest[4 * i + SIGN_OFS] = 255 if (r >= 128) else 0
+
+    def bench(name, fn):
+        dest = bytearray(4 * pixelCount)
+        t = time.perf_counter()
+        for f in range(frames // 10 if (fn is per_pixel) else frames):
+            fn(words, dest)
+        t = time.perf_counter() - t
+        print("%-14s %12.0f pixels/sec" % (name, (frames // 10 if (fn is per_pixel) else frames) * pixelCount / t))
+        return dest
+
+    ref = bench("per pixel", per_pixel)
+    paths = [("translate", TransformChain(chain, useNumpy=False))]
+    if (HAVE_NUMPY):
+        paths.append(("numpy", TransformChain(chain, useNumpy=True)))
+    for name, tc in paths:
+        out = bench(name, lambda w, d: tc.apply(w, pixelCount, 0, d))
+        # fused tables round once per transform, like the per pixel path
+        if (out != ref):
+            print("%s output does not match the per pixel path!" % name)
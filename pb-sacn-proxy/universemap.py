@@ -0,0 +1,156 @@
+"""
+ universemap.py
+
+ Declarative mapping of sACN universes onto a Pixelblaze's pixel buffer.  Each
+ row of the map describes one run of pixels:
+
+   universe      - the sACN universe carrying the data
+   startChannel  - first DMX channel of the run (1-512, DMX numbering)
+   pixelCount    - number of pixels in the run
+   destOffset    - index of the run's first pixel in the Pixelblaze's buffer
+   colorOrder    - channel order of the source data: RGB, GRB, BGR or RGBW
+
+ The map is compiled once, at startup, into per-universe lists of segments
+ holding precomputed slices and index arrays, so handling a packet costs one
+ dictionary lookup plus a bulk copy per segment.
+
+ A map may be loaded from a JSON file containing a list of rows, for example:
+
+   [ {"universe": 1, "startChannel": 1, "pixelCount": 170, "destOffset": 0},
+     {"universe": 2, "pixelCount": 100, "destOffset": 170, "colorOrder": "GRB"} ]
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+import json
+from pixelpack import numpy
+
+# offsets of the red, green, blue and (optional) white channels within a
+# pixel's group of DMX channels, for each supported color order
+COLOR_ORDERS = {
+    "RGB":  (0, 1, 2),
+    "GRB":  (1, 0, 2),
+    "BGR":  (2, 1, 0),
+    "RGBW": (0, 1, 2, 3),
+}
+
+DMX_CHANNELS = 512
+
+
+class Segment:
+    """
+    A compiled universe map row.  Holds everything needed to pack the row's
+    pixels from a DMX data buffer without further computation.
+    """
+    universe = 0
+    first = 0         # zero-based offset of the first DMX channel
+    last = 0          # offset one past the last DMX channel
+    pixelCount = 0
+    destOffset = 0
+    stride = 3        # channels per pixel
+    order = None      # channel offsets of r, g, b (and w)
+    hasWhite = False
+    slices = None     # per-channel slices of the segment's channel data
+    index = None      # numpy (pixelCount, stride) gather indices, if numpy is available
+
+    def __init__(self, universe, startChannel, pixelCount, destOffset, colorOrder):
+        self.order = COLOR_ORDERS.get(colorOrder.upper())
+        if (self.order is None):
+            raise ValueError("Unsupported color order: %s" % colorOrder)
+        if (universe < 1 or universe > 63999):
+            raise ValueError("Invalid sACN universe: %d" % universe)
+
+        self.universe = universe
+        self.stride = len(self.order)
+        self.hasWhite = (self.stride == 4)
+        self.first = max(0, startChannel - 1)
+        self.pixelCount = max(0, min(pixelCount, (DMX_CHANNELS - self.first) // self.stride))
+        self.last = self.first + self.stride * self.pixelCount
+        self.destOffset = destOffset
+
+        self.slices = tuple(slice(ofs, None, self.stride) for ofs in self.order)
+        if (numpy is not None):
+            base = numpy.arange(self.pixelCount, dtype=numpy.intp) * self.stride
+            self.index = base[:, None] + numpy.array(self.order, dtype=numpy.intp)
+
+    def end(self):
+        """Returns the index one past the segment's last destination pixel"""
+        return self.destOffset + self.pixelCount
+
+
+class UniverseMap:
+    """
+    Table of universe-to-pixel mappings.  Rows are added with add(), or
+    loaded from a list of dictionaries or a JSON file.
+    """
+    rows = None
+
+    def __init__(self, rows = None):
+        self.rows = []
+        if (rows is not None):
+            for row in rows:
+                self.add(**row)
+
+    @classmethod
+    def default(cls, universes, pixelsPerUniverse, firstUniverse = 1):
+        """
+        Returns the classic layout: <universes> consecutive universes starting
+        at firstUniverse, each carrying pixelsPerUniverse RGB pixels, laid end
+        to end.
+        """
+        m = cls()
+        for u in range(universes):
+            m.add(firstUniverse + u, 1, pixelsPerUniverse, u * pixelsPerUniverse)
+        return m
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a universe map from a JSON file containing a list of rows"""
+        with open(filename, "r") as f:
+            return cls(json.load(f))
+
+    def add(self, universe, startChannel = 1, pixelCount = 170, destOffset = 0, colorOrder = "RGB"):
+        """Adds a row to the map."""
+        self.rows.append((universe, startChannel, pixelCount, destOffset, colorOrder))
+
+    def compile(self, offset = 0, table = None):
+        """
+        Builds the per-packet lookup table. Returns a dictionary mapping each
+        universe number to a tuple of its compiled segments.  Destination
+        offsets are shifted by offset pixels, and the segments are added
+        to table if one is given, so that maps for several Pixelblazes can
+        share one buffer.
+        """
+        if (table is None):
+            table = dict()
+        for (universe, startChannel, pixelCount, destOffset, colorOrder) in self.rows:
+            seg = Segment(universe, startChannel, pixelCount, destOffset + offset, colorOrder)
+            table[seg.universe] = table.get(seg.universe, ()) + (seg,)
+        return table
+
+    def universes(self):
+        """Returns a sorted list of the universes used by the map"""
+        return sorted(set(row[0] for row in self.rows))
+
+    def pixelCount(self):
+        """Returns the size of the pixel buffer needed to hold the mapped pixels"""
+        end = 0
+        for segs in self.compile().values():
+            for seg in segs:
+                end = max(end, seg.end())
+        return end
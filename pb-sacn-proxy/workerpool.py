@@ -0,0 +1,334 @@
+"""
+ workerpool.py
+
+ Spreads the Pixelblaze outputs across several worker processes, so encoding
+ and sending for a large installation isn't limited to the one core the GIL
+ lets a single process use.
+
+ The receiver process writes each assembled frame into a SharedFrameRing, a
+ ring of frame slots in shared memory.  Every slot is guarded by a process
+ shared lock, whose acquire and release are the memory barriers that make
+ the frame bytes written on one core visible, complete, on another -- plain
+ stores to shared memory are not ordered across cores on ARM boards like the
+ Raspberry Pi.  Each slot also carries the number of the frame it holds, so
+ a reader can tell when the writer has moved on and reused the slot.
+
+ Nobody waits on a lock indefinitely: a worker killed while copying a frame
+ would otherwise leave its slot locked, and hang the receiver.  The writer
+ takes whichever slot it can lock without waiting -- there are always more
+ slots than readers -- and the header records which slot holds the latest
+ frame.  Readers give up on a slot after _LOCK_TIMEOUT.
+
+ Each worker process connects to its share of the Pixelblazes and runs an
+ ordinary PixelblazeOutput for each, fed from a FrameStore local to the
+ worker.  Workers periodically report their CPU use and their outputs'
+ statistics back to the receiver process.
+
+ Copyright 2020 JEM (ZRanger1)
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy of this
+ software and associated documentation files (the "Software"), to deal in the Software
+ without restriction, including without limitation the rights to use, copy, modify, merge,
+ publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons
+ to whom the Software is furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in all copies or
+ substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+ BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE
+ AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+"""
+from multiprocessing import shared_memory
+from framestore import FrameStore
+import multiprocessing
+import queue
+import struct
+import time
+import os
+
+# ring layout: a header holding the number of the latest frame and the slot
+# it's in, then <slots> slots, each a frame number and frame time followed by
+# the frame.
+_HEADER = struct.Struct("=QQ")
+_SLOT = struct.Struct("=Qd")
+_HEADER_SIZE = 16
+_RETRIES = 8
+_LOCK_TIMEOUT = 0.05       # seconds a reader waits for a slot
+
+
+class SharedFrameRing:
+    """
+    Single writer, multiple reader ring of frames in shared memory.  The
+    writer creates the ring; readers in other processes attach to it by name,
+    passing the writer's locks.
+    """
+    name = None
+    frameSize = 0
+    slots = 4
+    written = 0
+    dropped = 0            # frames not written because every slot was locked
+    locks = ()
+
+    def __init__(self, frameSize, slots = 4, name = None, locks = None):
+        """
+        Creates a ring for frames of frameSize bytes, or attaches to ring <name>,
+        whose slot locks are <locks>.
+        """
+        self.frameSize = frameSize
+        self.slots = max(2, slots)
+        self._stride = _SLOT.size + frameSize
+        self._owner = (name is None)
+        if (self._owner):
+            self._shm = shared_memory.SharedMemory(create=True, size=_HEADER_SIZE + self.slots * self._stride)
+            self._shm.buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+            ctx = multiprocessing.get_context("spawn")
+            self.locks = tuple(ctx.Lock() for i in range(self.slots))
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self.locks = tuple(locks)
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+
+    def _slot(self, slot):
+        """Utility method: returns the buffer offset of a slot"""
+        return _HEADER_SIZE + slot * self._stride
+
+    def write(self, frame, frameTime = None):
+        """
+        Writes frame (bytes-like, frameSize bytes) as the latest frame. Writer
+        only.  Returns False if the frame was dropped because no slot could be
+        locked, which only happens if readers died holding most of them.
+        """
+        seq = self.written + 1
+        t = time.monotonic() if (frameTime is None) else frameTime
+        # try the oldest slots first, leaving the latest frame readable
+        last = _HEADER.unpack_from(self._buf, 0)[1]
+        for i in range(1, self.slots + 1):
+            slot = (last + i) % self.slots
+            if (self.locks[slot].acquire(False)):
+                break
+        else:
+            self.dropped += 1
+            return False
+        try:
+            ofs = self._slot(slot)
+            _SLOT.pack_into(self._buf, ofs, seq, t)
+            self._buf[ofs + _SLOT.size:ofs + self._stride] = frame
+        finally:
+            self.locks[slot].release()
+        # the header may briefly point at an older frame, which a reader just takes
+        _HEADER.pack_into(self._buf, 0, seq, slot)
+        self.written = seq
+        return True
+
+    def latest(self):
+        """Returns the number of the latest frame written, 0 if none"""
+        return _HEADER.unpack_from(self._buf, 0)[0]
+
+    def read(self, into):
+        """
+        Copies the latest frame into the bytearray <into>.  Returns (frameNumber,
+        frameTime), or (0, 0) if no frame has been written or the writer kept
+        reusing the latest frame's slot before we got to it.
+        """
+        for attempt in range(_RETRIES):
+            seq, slot = _HEADER.unpack_from(self._buf, 0)
+            if (seq == 0):
+                return (0, 0)
+            if (slot >= self.slots):
+                continue           # caught the header mid-update
+            lock = self.locks[slot]
+            if (not lock.acquire(timeout=_LOCK_TIMEOUT)):
+                continue
+            try:
+                held, t = _SLOT.unpack_from(self._buf, self._slot(slot))
+                if (held == seq):
+                    ofs = self._slot(slot)
+                    into[:] = self._buf[ofs + _SLOT.size:ofs + self._stride]
+                    return (seq, t)
+            finally:
+                lock.release()
+        return (0, 0)
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        if (self._owner):
+            self._shm.unlink()
+
+
+def _worker(ringName, frameSize, slots, locks, specs, wake, stopping, reports, notify_ms):
+    """
+    Worker process: connects to its Pixelblazes, then copies each new frame
+    from the shared ring into a local frame store and wakes the outputs.
+    """
+    from output import PixelblazeOutput
+    from discovery import DeviceCache
+
+    caches = dict()            # cache file -> DeviceCache, shared by this worker's outputs
+    ring = SharedFrameRing(frameSize, slots, ringName, locks)
+    store = FrameStore(frameSize, len(specs))
+    frame = bytearray(frameSize)
+    outputs = []
+    try:
+        for i, spec in enumerate(specs):
+            cacheFile = spec["cacheFile"]
+            if ((cacheFile is not None) and (cacheFile not in caches)):
+                caches[cacheFile] = DeviceCache(cacheFile)
+            out = PixelblazeOutput(spec["addr"], pixelCount=spec["pixelCount"], cache=caches.get(cacheFile))
+            ttl = spec["cacheTtl"]
+            if (ttl is not None):
+                out.pb.enableCache(ttl["patterns"], ttl["config"], ttl["controls"])
+            out.pb.setBatching(spec["batching"])
+            out.base = spec["base"]
+            out.mapPixels = spec["mapPixels"]
+            out.setMaxOutputFps(spec["maxFps"])
+            out.refreshInterval = spec["refreshInterval"]
+            out.targetLatency = spec["targetLatency"]
+            out.show_fps = spec["show_fps"]
+            out.setTransforms(spec["transforms"])
+            if (spec["resampling"] is not None):
+                out.setResampling(**spec["resampling"])
+            out.notify_ms = notify_ms
+            out.attach(store, i)
+            out.start()
+            outputs.append(out)
+
+        lastSeq = 0
+        skipped = 0
+        timer = time.monotonic()
+        cpu = time.process_time()
+        while (not stopping.is_set()):
+            if (wake.wait(notify_ms / 1000)):
+                wake.clear()
+                seq, frameTime = ring.read(frame)
+                if (seq > lastSeq):
+                    if (lastSeq > 0):
+                        skipped += seq - lastSeq - 1
+                    lastSeq = seq
+                    store.publish(frame, frameTime)
+                    for out in outputs:
+                        out.publish()
+
+            t = time.monotonic() - timer
+            if (t * 1000 >= notify_ms):
+                stats = [out.stats() for out in outputs]
+                reports.put({
+                    "pid": os.getpid(),
+                    "cpu": 100 * (time.process_time() - cpu) / t,
+                    "fps": sum(s["fps"] for s in stats),
+                    "skipped": skipped,
+                    "overwritten": store.overwritten,
+                    "lost": store.lost,
+                    "outputs": stats,
+                })
+                timer = time.monotonic()
+                cpu = time.process_time()
+
+    except Exception as blarf:
+        template = "Worker {0} halted by unexpected exception. Type: {1},  Args:\n{2!r}"
+        print(template.format(os.getpid(), type(blarf).__name__, blarf.args))
+
+    finally:
+        for out in outputs:
+            out.stop()
+        ring.close()
+
+
+class WorkerPool:
+    """
+    Runs the proxy's outputs in <workers> worker processes fed from a shared
+    frame ring.  Outputs are dealt out to the workers round robin.
+    """
+    workers = 2
+    slots = 4
+    notify_ms = 3000
+    ring = None
+
+    def __init__(self, frameSize, workers = 2, slots = 4):
+        self.workers = max(1, workers)
+        # each worker locks at most one slot, so the writer always finds a free one
+        self.slots = max(slots, self.workers + 2)
+        self.ring = SharedFrameRing(frameSize, self.slots)
+        self.reports = dict()
+        self._processes = []
+        self._wake = []
+        self._stopping = None
+        self._queue = None
+
+    def start(self, outputs):
+        """
+        Starts the worker processes for the given PixelblazeOutputs.  Their
+        universe maps must already be compiled.  The outputs' own connections
+        are closed -- each worker opens its own.
+        """
+        ctx = multiprocessing.get_context("spawn")
+        self._stopping = ctx.Event()
+        self._queue = ctx.Queue()
+        workers = min(self.workers, len(outputs))
+        for w in range(workers):
+            specs = []
+            for out in outputs[w::workers]:
+                out.pb.close()
+                specs.append({
+                    "addr": out.addr,
+                    "pixelCount": out.pixelCount,
+                    "base": out.base,
+                    "mapPixels": out.mapPixels,
+                    "maxFps": out.maxFps,
+                    "refreshInterval": out.refreshInterval,
+                    "targetLatency": out.targetLatency,
+                    "show_fps": out.show_fps,
+                    "transforms": out.transforms.transforms,
+                    "resampling": out.resampling,
+                    "cacheFile": None if (out.cache is None) else out.cache.filename,
+                    "cacheTtl": out.pb._cacheTtl,
+                    "batching": out.pb.batching,
+                })
+            wake = ctx.Event()
+            p = ctx.Process(target=_worker, name="pb-worker-%d" % w, daemon=True,
+                            args=(self.ring.name, self.ring.frameSize, self.ring.slots, self.ring.locks, specs,
+                                  wake, self._stopping, self._queue, self.notify_ms))
+            p.start()
+            self._wake.append(wake)
+            self._processes.append(p)
+
+    def publish(self, frame, frameTime = None):
+        """Called from the receiver thread: writes frame to the ring and wakes the workers"""
+        self.ring.write(frame, frameTime)
+        for wake in self._wake:
+            wake.set()
+
+    def poll(self):
+        """Collects the workers' latest reports.  Returns a dictionary of reports by pid."""
+        while (self._queue is not None):
+            try:
+                report = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.reports[report["pid"]] = report
+        return self.reports
+
+    def stats(self):
+        """Returns a list of the outputs' statistics, as most recently reported"""
+        return [s for r in self.poll().values() for s in r["outputs"]]
+
+    def print_stats(self):
+        for pid, r in sorted(self.poll().items()):
+            print("worker %d: cpu %.0f%%, %.1f fps, %d outputs, skipped: %d, lost: %d" %
+                  (pid, r["cpu"], r["fps"], len(r["outputs"]), r["skipped"], r["lost"]))
+
+    def stop(self):
+        if (self._stopping is not None):
+            self._stopping.set()
+        for wake in self._wake:
+            wake.set()
+        for p in self._processes:
+            p.join(2)
+            if (p.is_alive()):
+                p.terminate()
+        self.ring.close()
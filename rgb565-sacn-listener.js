@@ -0,0 +1,12 @@
+// Compact companion to rgb-sacn-listener.js.  Each value in pixels565 holds
+// two RGB565 pixels: the first in the integer part, the second in the
+// fractional part.  sacnproxy.py switches to this format automatically when
+// the active pattern exports pixels565.
+export var pixels565 = array(ceil(pixelCount / 2))
+
+export function render(index) {
+  var p = pixels565[index >> 1]
+  if (index & 1) p = p * 256 * 256   // shift the second pixel into the integer part
+  r = (p >> 11) & 0x1f; g = (p >> 5) & 0x3f; b = p & 0x1f
+  rgb(r / 31, g / 63, b / 31)
+}